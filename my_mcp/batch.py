@@ -0,0 +1,278 @@
+"""
+Batch runner: answer a JSONL file of queries with MCPAgent.
+
+Every input line is a JSON object with a "query" and an optional "id"
+(default: the line number). Items are read lazily and answered by
+--concurrency workers; each item gets its own agent (its own
+conversation), all agents share one ServerPool, one ChatDeepSeek client
+and one tool result cache. Results are appended to the output file as
+they finish, one JSON object per line:
+
+    {"id": ..., "ok": true, "answer": "...", "started_at": ..., "elapsed_s": ..., "usage": {...}}
+    {"id": ..., "ok": false, "error": "...", "error_type": "LLMRequestError", "status": 429, ...}
+
+Running again with the same output file resumes: ids that already have
+an ok result are skipped, failed items are tried again (the last line for
+an id wins).
+
+    cd my_mcp
+    python batch.py --config mcp_servers_config.json -i queries.jsonl -o results.jsonl --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import logging
+
+import codec
+from llm.chat_deepseek import ChatDeepSeek
+from llm.scheduler import LLMRequestError, get_llm_scheduler
+from process_mcp.agent import MCPAgent, api_key, base_url
+from process_mcp.pool import ServerPool
+from process_mcp.tool_cache import ToolResultCache
+from metrics import BATCH_ITEMS_TOTAL, BATCH_ITEM_SECONDS
+
+logger = logging.getLogger("my_mcp")
+
+
+def read_items(input_path: str) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    Yield (id, query, error) for every non-empty input line without loading
+    the whole file; error is set for lines that are not a usable item.
+    """
+    with open(input_path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = codec.loads(line)
+            except codec.DecodeError as e:
+                yield str(lineno), None, f"Invalid JSON on line {lineno}: {str(e)}"
+                continue
+            if not isinstance(item, dict):
+                yield str(lineno), None, f"Line {lineno} is not a JSON object"
+                continue
+            item_id = str(item.get("id", lineno))
+            query = item.get("query")
+            if not isinstance(query, str) or not query.strip():
+                yield item_id, None, f"Line {lineno} has no query"
+                continue
+            yield item_id, query, None
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    """Ids that already have a successful result in output_path."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = codec.loads(line)
+            except codec.DecodeError:
+                # 上次中断时写了一半的行
+                continue
+            if not isinstance(record, dict) or "id" not in record:
+                continue
+            if record.get("ok"):
+                done.add(str(record["id"]))
+            else:
+                done.discard(str(record["id"]))
+    return done
+
+
+class BatchRunner:
+    """
+    Runs the items of one input file through per-item agents with at most
+    concurrency items in flight. The input is read lazily through a
+    bounded queue, so memory stays flat however long the file is.
+    """
+    def __init__(self, mcp_config_path: str, input_path: str, output_path: str,
+                 concurrency: int = 8, item_timeout: float = None, log_dir: str = None,
+                 resume: bool = True, llm_client: ChatDeepSeek = None, server_pool: ServerPool = None,
+                 agent_options: Dict = None):
+        self.mcp_config_path = mcp_config_path
+        self.input_path = input_path
+        self.output_path = output_path
+        self.concurrency = max(1, concurrency)
+        self.item_timeout = item_timeout
+        self.log_dir = log_dir
+        self.resume = resume
+        self._close_llm = llm_client is None
+        self._close_pool = server_pool is None
+        self.llm = llm_client if llm_client is not None else ChatDeepSeek(api_key=api_key, base_url=base_url)
+        self.server_pool = server_pool if server_pool is not None else ServerPool()
+        self.tool_cache = ToolResultCache()
+        self.agent_options = agent_options or {}
+        self.counts = {"ok": 0, "error": 0, "skipped": 0}
+        self._latencies = []
+        self._output = None
+
+    async def run(self) -> Dict:
+        """Process the whole input file and return a summary."""
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+        skip = completed_ids(self.output_path) if self.resume else set()
+        if skip:
+            logger.info(f"Resuming: {len(skip)} items already completed")
+        self._output = self._open_output()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        start = time.perf_counter()
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            seen = set()
+            for item_id, query, error in read_items(self.input_path):
+                if item_id in skip or item_id in seen:
+                    # 重复的 id 只处理第一次出现的
+                    self.counts["skipped"] += 1
+                    BATCH_ITEMS_TOTAL.inc(status="skipped")
+                    continue
+                seen.add(item_id)
+                await queue.put((item_id, query, error))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._output.close()
+            if self._close_pool:
+                await self.server_pool.close()
+            if self._close_llm:
+                await self.llm.close()
+        return self.summary(time.perf_counter() - start)
+
+    def _open_output(self):
+        mode = "a" if self.resume else "w"
+        f = open(self.output_path, mode, encoding="utf-8")
+        # 上次中断时最后一行可能没有写完，先补上换行
+        if mode == "a" and f.tell() > 0:
+            with open(self.output_path, "rb") as check:
+                check.seek(-1, os.SEEK_END)
+                if check.read(1) != b"\n":
+                    f.write("\n")
+        return f
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            record = await self._run_item(*item)
+            self._write(record)
+
+    async def _run_item(self, item_id: str, query: Optional[str], error: Optional[str]) -> Dict:
+        record = {"id": item_id, "started_at": time.time()}
+        if error is not None:
+            return {**record, "ok": False, "error": error, "error_type": "InvalidItem", "elapsed_s": 0.0}
+        start = time.perf_counter()
+        agent = None
+        try:
+            agent = await MCPAgent.create(
+                mcp_server_config_path=self.mcp_config_path,
+                log_messages_path=self._log_path(item_id),
+                server_pool=self.server_pool,
+                llm_client=self.llm,
+                tool_cache=self.tool_cache,
+                verbose=False,
+                **self.agent_options
+            )
+            answer = await asyncio.wait_for(agent.prompt(query, stream=False), self.item_timeout)
+            record.update(ok=True, answer=answer)
+        except asyncio.TimeoutError:
+            record.update(ok=False, error=f"Timed out after {self.item_timeout}s", error_type="TimeoutError")
+        except LLMRequestError as e:
+            record.update(ok=False, error=str(e), error_type="LLMRequestError", status=e.status)
+        except Exception as e:
+            logger.error(f"Batch item {item_id} failed: {str(e)}")
+            record.update(ok=False, error=str(e), error_type=type(e).__name__)
+        finally:
+            if agent is not None:
+                record["usage"] = agent.last_usage
+                await agent.cleanup()
+        elapsed = time.perf_counter() - start
+        record["elapsed_s"] = round(elapsed, 3)
+        self._latencies.append(elapsed)
+        BATCH_ITEM_SECONDS.observe(elapsed)
+        return record
+
+    def _log_path(self, item_id: str) -> Optional[str]:
+        if not self.log_dir:
+            return None
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", item_id)[:128]
+        return os.path.join(self.log_dir, f"{safe_id}.jsonl")
+
+    def _write(self, record: Dict):
+        status = "ok" if record["ok"] else "error"
+        self.counts[status] += 1
+        BATCH_ITEMS_TOTAL.inc(status=status)
+        # 每条结果立即写入并刷新，中断后可以从输出文件恢复
+        self._output.write(codec.dumps(record, ensure_ascii=False) + "\n")
+        self._output.flush()
+
+    def summary(self, wall: float) -> Dict:
+        latencies = sorted(self._latencies)
+        processed = self.counts["ok"] + self.counts["error"]
+        return {
+            **self.counts,
+            "wall_s": round(wall, 3),
+            "items_per_s": round(processed / wall, 3) if wall else 0.0,
+            "p50_s": round(latencies[len(latencies) // 2], 3) if latencies else None,
+            "max_s": round(latencies[-1], 3) if latencies else None,
+            "llm": self.llm.scheduler.stats()
+        }
+
+
+async def _main(args):
+    runner = BatchRunner(
+        mcp_config_path=args.config,
+        input_path=args.input,
+        output_path=args.output,
+        concurrency=args.concurrency,
+        item_timeout=args.item_timeout,
+        log_dir=args.log_dir,
+        resume=not args.no_resume,
+        agent_options={"lazy_start": not args.eager}
+    )
+    summary = await runner.run()
+    print(codec.dumps(summary), file=sys.stderr)
+    return 1 if summary["error"] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", required=True, help="path of mcp_servers_config.json")
+    parser.add_argument("-i", "--input", required=True, help="JSONL file of {\"id\": ..., \"query\": ...}")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file the results are appended to")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="items answered at once")
+    parser.add_argument("--item-timeout", type=float, help="seconds one item may take")
+    parser.add_argument("--log-dir", help="write one message log per item into this directory")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="overwrite the output instead of skipping ids it already completed")
+    parser.add_argument("--eager", action="store_true",
+                        help="start every server for each item instead of on first use")
+    parser.add_argument("--llm-rpm", type=float, help="LLM requests per minute (default: DS_REQUESTS_PER_MINUTE)")
+    parser.add_argument("--llm-tpm", type=float, help="LLM tokens per minute (default: DS_TOKENS_PER_MINUTE)")
+    parser.add_argument("--llm-max-concurrency", type=int,
+                        help="LLM requests in flight (default: DS_MAX_CONCURRENCY or 16)")
+    args = parser.parse_args()
+    get_llm_scheduler().configure(args.llm_rpm, args.llm_tpm, args.llm_max_concurrency)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    try:
+        sys.exit(asyncio.run(_main(args)))
+    except KeyboardInterrupt:
+        # 已完成的结果都在输出文件中，再次运行会跳过它们
+        print("Interrupted, run again with the same --output to resume", file=sys.stderr)
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Micro-benchmarks for the JSON codec on the agent's hot paths.
+
+Compares the previous stdlib json calls with codec.py (orjson/msgspec when
+installed) on large tool payloads:
+
+    cd my_mcp
+    python bench/bench_codec.py
+    python bench/bench_codec.py --result-bytes 4000000 --number 20
+    MY_MCP_JSON=json python bench/bench_codec.py     # force the stdlib backend
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec  # noqa: E402
+
+
+def _payloads(result_bytes, tools):
+    text = ("lorem ipsum dolor sit amet, 中文内容 " * (result_bytes // 40 + 1))[:result_bytes]
+    result = {"content": [{"type": "text", "text": text}], "isError": False}
+    response = {"jsonrpc": "2.0", "id": 42, "result": result}
+    functions = [
+        {
+            "type": "function",
+            "function": {
+                "name": f"srv_tool_{i}",
+                "description": "Fake tool description. " * 10,
+                "parameters": {"type": "object", "properties": {
+                    "x": {"type": "string", "description": "any value"},
+                    f"option_{i}": {"type": "integer"}
+                }, "required": ["x"]}
+            }
+        }
+        for i in range(tools)
+    ]
+    messages = [{"role": "tool", "tool_call_id": f"call_{i}", "name": "srv_tool_0",
+                 "content": json.dumps(result)[:20000], "session": "s", "time": 0.0}
+                for i in range(50)]
+    return result, response, functions, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--result-bytes", type=int, default=1_000_000, help="size of the tool result text")
+    parser.add_argument("--tools", type=int, default=600, help="number of tools in the tools payload")
+    parser.add_argument("--number", type=int, default=50, help="iterations per case")
+    args = parser.parse_args()
+
+    result, response, functions, messages = _payloads(args.result_bytes, args.tools)
+    line = (json.dumps(response) + "\n").encode()
+    arguments = json.dumps({"query": "x" * 2000, "limit": 10, "filters": {"a": [1, 2, 3]}})
+
+    cases = [
+        ("stdio send (encode request line)",
+         lambda: (json.dumps(response) + "\n").encode(),
+         lambda: codec.dumpb(response) + b"\n"),
+        ("stdio receive (decode response line)",
+         lambda: json.loads(line),
+         lambda: codec.loads(line)),
+        ("tool result -> message content",
+         lambda: json.dumps(result),
+         lambda: codec.dumps(result)),
+        ("tool arguments decode",
+         lambda: json.loads(arguments),
+         lambda: codec.loads(arguments)),
+        ("tools payload serialize",
+         lambda: json.dumps(functions, ensure_ascii=False, separators=(",", ":")),
+         lambda: codec.dumpb(functions)),
+        ("log batch (50 records)",
+         lambda: "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode(),
+         lambda: b"".join(codec.dumpb(m, ensure_ascii=False) + b"\n" for m in messages)),
+    ]
+
+    print(f"backend: {codec.BACKEND}, result: {args.result_bytes} bytes, tools: {args.tools}")
+    print(f"{'case':40} | {'stdlib ms':>10} | {'codec ms':>10} | speedup")
+    for name, baseline, candidate in cases:
+        base = min(timeit.repeat(baseline, number=args.number, repeat=3)) / args.number * 1000
+        new = min(timeit.repeat(candidate, number=args.number, repeat=3)) / args.number * 1000
+        print(f"{name:40} | {base:10.3f} | {new:10.3f} | {base / new if new else float('inf'):6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Local OpenAI-compatible fake chat completions endpoint for the benchmarks.
+
+Implements POST /chat/completions (streaming and non-streaming) on top of
+asyncio streams with HTTP/1.1 keep-alive, so it has no dependencies. The
+replies are scripted: for the first `tool_depth` rounds after each user
+message it asks for `parallel_calls` tool calls, then answers with
+`answer_tokens` tokens of text.
+
+Usage is reported like DeepSeek's context cache: a prompt (tools, then
+messages) is cached, and the longest prefix it shares with a recent prompt
+counts as prompt_cache_hit_tokens, in 64-token units of ~4 characters.
+With `max_rps`, requests beyond that many per second get a 429 with Retry-After.
+
+    python bench/fake_llm_server.py --port 8000 --tool-depth 2 --parallel-calls 3
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+
+class FakeLLMServer:
+    def __init__(self, tool_depth: int = 1, parallel_calls: int = 1, answer_tokens: int = 50,
+                 ttft: float = 0.0, token_interval: float = 0.0, max_rps: float = None):
+        self.tool_depth = tool_depth
+        self.parallel_calls = parallel_calls
+        self.answer_tokens = answer_tokens
+        self.ttft = ttft
+        self.token_interval = token_interval
+        self.max_rps = max_rps
+        self.rejected = 0 # 因超过 max_rps 返回 429 的请求数
+        self._accepted_at = [] # 最近一秒内接受的请求时间
+        self.requests = 0
+        self.busy_seconds = 0.0 # 服务端处理请求（包括模拟延迟）的总时间
+        self._prompts = [] # 最近的请求前缀，模拟上下文缓存
+        self.port = None
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, port: int = 0):
+        self._server = await asyncio.start_server(self._handle_connection, "127.0.0.1", port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # ---- scripted replies ---- #
+    def _plan(self, request):
+        """Return (tool_calls, text) for the next assistant message."""
+        messages = request.get("messages", [])
+        rounds = 0
+        for m in reversed(messages):
+            if m.get("role") == "user":
+                break
+            if m.get("role") == "assistant" and m.get("tool_calls"):
+                rounds += 1
+        tools = [t["function"]["name"] for t in request.get("tools") or []
+                 if not t["function"]["name"].startswith("blobstore_")]
+        if rounds < self.tool_depth and tools:
+            stride = max(1, len(tools) // max(1, self.parallel_calls))
+            calls = []
+            for i in range(self.parallel_calls):
+                name = tools[(rounds * self.parallel_calls + i * stride) % len(tools)]
+                calls.append({
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps({"x": f"round {rounds} call {i}"})}
+                })
+            return calls, ""
+        words = ["token"] * self.answer_tokens
+        return [], " ".join(words)
+
+    # ---- simulated context cache ---- #
+    @staticmethod
+    def _common_prefix(a: str, b: str) -> int:
+        lo, hi = 0, min(len(a), len(b))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if a[:mid] == b[:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def _usage(self, request, tool_calls, text):
+        prompt = json.dumps(request.get("tools") or []) + json.dumps(request.get("messages") or [])
+        hit_chars = max((self._common_prefix(prompt, p) for p in self._prompts), default=0)
+        self._prompts = (self._prompts + [prompt])[-32:]
+        prompt_tokens = len(prompt) // 4
+        hit = min(prompt_tokens, hit_chars // 4 // 64 * 64)
+        completion = len(text.split()) + 10 * len(tool_calls)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion,
+                "total_tokens": prompt_tokens + completion,
+                "prompt_cache_hit_tokens": hit, "prompt_cache_miss_tokens": prompt_tokens - hit}
+
+    def _completion(self, request, tool_calls, text):
+        message = {"role": "assistant", "content": text or None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "message": message,
+                         "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": self._usage(request, tool_calls, text)
+        }
+
+    def _chunk(self, request, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+
+    def _stream_chunks(self, request, tool_calls, text):
+        yield self._chunk(request, {"role": "assistant", "content": ""})
+        if tool_calls:
+            for index, tc in enumerate(tool_calls):
+                args = tc["function"]["arguments"]
+                half = len(args) // 2
+                yield self._chunk(request, {"tool_calls": [{
+                    "index": index, "id": tc["id"], "type": "function",
+                    "function": {"name": tc["function"]["name"], "arguments": args[:half]}
+                }]})
+                yield self._chunk(request, {"tool_calls": [{
+                    "index": index, "function": {"arguments": args[half:]}
+                }]})
+            yield self._chunk(request, {}, "tool_calls")
+        else:
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                yield self._chunk(request, {"content": word if i == 0 else " " + word})
+            yield self._chunk(request, {}, "stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            yield {**self._chunk(request, {}), "choices": [], "usage": self._usage(request, tool_calls, text)}
+
+    # ---- HTTP ---- #
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                if method != "POST" or not path.rstrip("/").endswith("/chat/completions"):
+                    await self._send(writer, 404, b'{"error": {"message": "not found"}}')
+                    continue
+                retry_after = self._throttle()
+                if retry_after is not None:
+                    self.rejected += 1
+                    await self._send(writer, 429, b'{"error": {"message": "rate limit exceeded", "type": "rate_limit"}}',
+                                     headers={"Retry-After": f"{retry_after:.3f}"})
+                    continue
+                started = time.perf_counter()
+                await self._handle_completion(writer, json.loads(body))
+                self.busy_seconds += time.perf_counter() - started
+                self.requests += 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _throttle(self):
+        """None if the request may proceed, else the seconds until it would be accepted."""
+        if not self.max_rps:
+            return None
+        now = time.monotonic()
+        self._accepted_at = [t for t in self._accepted_at if now - t < 1]
+        if len(self._accepted_at) >= self.max_rps:
+            return 1 - (now - self._accepted_at[0])
+        self._accepted_at.append(now)
+        return None
+
+    async def _send(self, writer, status, body: bytes, content_type="application/json", headers=None):
+        extra = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
+        writer.write(
+            f"HTTP/1.1 {status} OK\r\nContent-Type: {content_type}\r\n{extra}"
+            f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def _handle_completion(self, writer, request):
+        tool_calls, text = self._plan(request)
+        if self.ttft:
+            await asyncio.sleep(self.ttft)
+        if not request.get("stream"):
+            if self.token_interval and text:
+                await asyncio.sleep(self.token_interval * self.answer_tokens)
+            await self._send(writer, 200, json.dumps(self._completion(request, tool_calls, text)).encode())
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n")
+        for chunk in self._stream_chunks(request, tool_calls, text):
+            data = f"data: {json.dumps(chunk)}\n\n".encode()
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+        await writer.drain()
+
+
+async def _serve(args):
+    server = await FakeLLMServer(
+        tool_depth=args.tool_depth,
+        parallel_calls=args.parallel_calls,
+        answer_tokens=args.answer_tokens,
+        ttft=args.ttft,
+        token_interval=args.token_interval,
+        max_rps=args.max_rps
+    ).start(args.port)
+    print(f"Fake LLM listening on {server.base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--tool-depth", type=int, default=1)
+    parser.add_argument("--parallel-calls", type=int, default=1)
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--ttft", type=float, default=0.0)
+    parser.add_argument("--token-interval", type=float, default=0.0)
+    parser.add_argument("--max-rps", type=float, help="answer 429 above this many requests per second")
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,40 @@
+"""
+Configurable fake SSE / streamable-HTTP MCP server used by the benchmarks (requires mcp[cli]
+with FastMCP and uvicorn, which come with the mcp package).
+
+    python bench/fake_sse_server.py --port 8765 --tools 20 --latency 0.05
+"""
+import argparse
+import asyncio
+
+from mcp.server.fastmcp import FastMCP
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--tools", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--result-bytes", type=int, default=256)
+    parser.add_argument("--transport", default="sse", choices=["sse", "streamable-http"])
+    args = parser.parse_args()
+
+    payload = ("lorem ipsum dolor sit amet " * (args.result_bytes // 27 + 1))[:args.result_bytes]
+    server = FastMCP("fake-sse", host="127.0.0.1", port=args.port, log_level="WARNING")
+
+    def make_tool(i):
+        async def tool(x: str = "") -> str:
+            if args.latency:
+                await asyncio.sleep(args.latency)
+            return payload
+        tool.__name__ = f"tool_{i}"
+        return tool
+
+    for i in range(args.tools):
+        server.add_tool(make_tool(i), name=f"tool_{i}", description=f"Fake tool {i}.")
+
+    server.run(transport=args.transport)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Configurable fake stdio MCP server used by the benchmarks.
+
+Speaks newline-delimited JSON-RPC on stdin/stdout, answers initialize,
+tools/list and tools/call, and handles requests concurrently so pipelining
+in the client is visible. Tools named in --hang never answer, and received
+notifications/cancelled are reported on stderr. --stderr-bytes makes every
+tool call log that much to stderr, like a chatty server.
+
+    python bench/fake_stdio_server.py --tools 20 --latency 0.05 --result-bytes 4096
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tools", type=int, default=5, help="number of tools to advertise")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each tool call takes")
+    parser.add_argument("--result-bytes", type=int, default=256, help="size of each tool result text")
+    parser.add_argument("--description-bytes", type=int, default=200, help="size of each tool description")
+    parser.add_argument("--hang", nargs="*", default=[], help="tools that never answer")
+    parser.add_argument("--stderr-bytes", type=int, default=0, help="bytes logged to stderr per tool call")
+    args = parser.parse_args()
+
+    lock = threading.Lock()
+    payload = ("lorem ipsum dolor sit amet " * (args.result_bytes // 27 + 1))[:args.result_bytes]
+    tools = [
+        {
+            "name": f"tool_{i}",
+            "description": (f"Fake tool {i}. " + "x" * args.description_bytes)[:args.description_bytes],
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "x": {"type": "string", "description": "any value"},
+                    f"option_{i}": {"type": "integer", "description": "unused option"}
+                }
+            }
+        }
+        for i in range(args.tools)
+    ]
+
+    def send(message):
+        data = json.dumps(message) + "\n"
+        with lock:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+    def handle(message):
+        mid = message["id"]
+        method = message.get("method")
+        if method == "initialize":
+            send({"jsonrpc": "2.0", "id": mid, "result": {
+                "protocolVersion": message["params"].get("protocolVersion", "2024-11-05"),
+                "capabilities": {"tools": {}},
+                "serverInfo": {"name": "fake-stdio", "version": "1.0.0"}
+            }})
+        elif method == "ping":
+            send({"jsonrpc": "2.0", "id": mid, "result": {}})
+        elif method == "tools/list":
+            send({"jsonrpc": "2.0", "id": mid, "result": {"tools": tools}})
+        elif method == "tools/call":
+            if message["params"].get("name") in args.hang:
+                return
+            if args.stderr_bytes:
+                with lock:
+                    for _ in range(args.stderr_bytes // 100 + 1):
+                        sys.stderr.write(f"debug: handling request {mid} " + "." * 70 + "\n")
+                    sys.stderr.flush()
+            if args.latency:
+                time.sleep(args.latency)
+            send({"jsonrpc": "2.0", "id": mid, "result": {
+                "content": [{"type": "text", "text": payload}],
+                "isError": False
+            }})
+        else:
+            send({"jsonrpc": "2.0", "id": mid, "error": {"code": -32601, "message": f"Unknown method {method}"}})
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if "id" in message and "method" in message:
+            threading.Thread(target=handle, args=(message,), daemon=True).start()
+        elif message.get("method") == "notifications/cancelled":
+            print(f"cancelled {message['params'].get('requestId')}", file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    main()
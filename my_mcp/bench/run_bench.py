@@ -0,0 +1,288 @@
+"""
+Offline end-to-end benchmarks for MCPAgent.
+
+Runs the agent against fake stdio/SSE MCP servers and a local fake
+OpenAI-compatible endpoint, so only the agent's own overhead is measured
+(no DeepSeek calls, no real tools).
+
+    cd my_mcp
+    python bench/run_bench.py                      # all scenarios
+    python bench/run_bench.py -s many_tools -s deep_loop --stream
+    python bench/run_bench.py --json bench_output.json
+
+For every scenario it reports startup time (MCPAgent.create), per-prompt
+wall time, agent overhead per LLM round trip (wall time minus fake LLM and
+tool time), prompt throughput, the context cache hit ratio reported by the
+fake LLM, one-shot run_interaction latency (cold and with a warm
+ServerPool) and memory. MCPAgent.create runs with an empty tool
+manifest cache, the run_interaction calls after it start lazily from the
+manifests it wrote.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_mcp.agent as agent_module  # noqa: E402
+from process_mcp.agent import MCPAgent, run_interaction  # noqa: E402
+from process_mcp.pool import ServerPool  # noqa: E402
+from bench.fake_llm_server import FakeLLMServer  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    "baseline": dict(servers=1, tools=5, result_bytes=256, tool_depth=1, parallel_calls=1, prompts=20),
+    "many_servers": dict(servers=12, tools=5, result_bytes=256, tool_depth=1, parallel_calls=3, prompts=10),
+    "many_tools": dict(servers=4, tools=150, result_bytes=256, tool_depth=1, parallel_calls=2, prompts=10),
+    "large_results": dict(servers=1, tools=3, result_bytes=1_000_000, tool_depth=2, parallel_calls=2, prompts=5),
+    "deep_loop": dict(servers=2, tools=5, result_bytes=1024, tool_depth=10, parallel_calls=1, prompts=5),
+    "parallel_calls": dict(servers=3, tools=5, result_bytes=256, tool_depth=2, parallel_calls=6,
+                           tool_latency=0.1, prompts=5),
+    # 流式输出较慢、服务器串行执行时，前面的工具调用可以在响应结束前开始执行（配合 --stream）
+    "streamed_calls": dict(servers=1, tools=5, result_bytes=256, tool_depth=1, parallel_calls=4, sequential=True,
+                           tool_latency=0.2, token_interval=0.05, answer_tokens=10, prompts=5),
+    # 长会话：对话超出上下文预算后需要压缩，观察上下文缓存命中率
+    "long_session": dict(servers=2, tools=30, result_bytes=8192, tool_depth=2, parallel_calls=2, prompts=20,
+                         context_token_budget=40000),
+    "sse": dict(servers=0, sse_servers=2, tools=5, result_bytes=256, tool_depth=1, parallel_calls=2, prompts=10),
+    "streamable_http": dict(servers=0, sse_servers=2, transport="streamable-http", tools=5, result_bytes=256,
+                            tool_depth=1, parallel_calls=2, prompts=10),
+}
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_port(port, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+
+async def _start_sse_servers(n, cfg):
+    procs, entries = [], {}
+    for i in range(n):
+        port = _free_port()
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "fake_sse_server.py"), "--port", str(port),
+             "--tools", str(cfg["tools"]), "--latency", str(cfg.get("tool_latency", 0.0)),
+             "--result-bytes", str(cfg["result_bytes"]), "--transport", cfg.get("transport", "sse")],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+        if not await _wait_port(port):
+            for p in procs:
+                p.kill()
+            return None, {}
+        if cfg.get("transport") == "streamable-http":
+            entries[f"http{i}"] = {"url": f"http://127.0.0.1:{port}/mcp", "transport": "streamable-http"}
+        else:
+            entries[f"sse{i}"] = {"url": f"http://127.0.0.1:{port}/sse"}
+    return procs, entries
+
+
+def _write_config(tmpdir, cfg, extra_servers):
+    servers = {}
+    for i in range(cfg["servers"]):
+        servers[f"srv{i}"] = {
+            "command": sys.executable,
+            "args": [os.path.join(BENCH_DIR, "fake_stdio_server.py"),
+                     "--tools", str(cfg["tools"]),
+                     "--latency", str(cfg.get("tool_latency", 0.0)),
+                     "--result-bytes", str(cfg["result_bytes"])]
+        }
+        if cfg.get("sequential"):
+            servers[f"srv{i}"]["sequential"] = True
+    servers.update(extra_servers)
+    path = os.path.join(tmpdir, "mcp_servers_config.json")
+    with open(path, "w") as f:
+        json.dump({"mcpServers": servers}, f)
+    return path
+
+
+async def _consume(agent, query):
+    response = await agent.prompt(query)
+    if agent.stream:
+        parts = []
+        async for chunk in response:
+            parts.append(chunk)
+        return "".join(parts)
+    return response
+
+
+async def run_scenario(name, cfg, stream=False, timeout=300.0):
+    llm_server = await FakeLLMServer(
+        tool_depth=cfg["tool_depth"],
+        parallel_calls=cfg["parallel_calls"],
+        answer_tokens=cfg.get("answer_tokens", 50),
+        token_interval=cfg.get("token_interval", 0.0)
+    ).start()
+    # 把全局 LLM 客户端指向本地假服务
+    llm = agent_module.llm
+    await llm.close()
+    llm.api_key, llm.base_url = "bench", llm_server.base_url + "/v1"
+
+    sse_procs = []
+    result = {"scenario": name, "stream": stream}
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            extra = {}
+            if cfg.get("sse_servers"):
+                sse_procs, extra = await _start_sse_servers(cfg["sse_servers"], cfg)
+                if sse_procs is None:
+                    sse_procs = []
+                    return {**result, "skipped": "fake SSE server did not start (is mcp installed?)"}
+            config_path = _write_config(tmpdir, cfg, extra)
+            log_path = os.path.join(tmpdir, "log_messages.log")
+            manifests = os.path.join(tmpdir, "manifests")
+            kwargs = dict(mcp_server_config_path=config_path, log_messages_path=log_path, stream=stream,
+                          blob_store_path=os.path.join(tmpdir, "blobs"), manifest_cache_path=manifests)
+            if "context_token_budget" in cfg:
+                kwargs["context_token_budget"] = cfg["context_token_budget"]
+
+            rss_before = _rss_mb()
+            tracemalloc.start()
+            sink = io.StringIO()
+            with contextlib.redirect_stdout(sink):
+                t0 = time.perf_counter()
+                agent = await asyncio.wait_for(MCPAgent.create(**kwargs), timeout)
+                result["startup_s"] = time.perf_counter() - t0
+                result["servers_started"] = sum(1 for r in agent.startup_report.values() if r["ok"])
+                result["tools"] = len(agent.all_functions)
+
+                requests_before, busy_before = llm_server.requests, llm_server.busy_seconds
+                latencies = []
+                t_all = time.perf_counter()
+                try:
+                    for i in range(cfg["prompts"]):
+                        t1 = time.perf_counter()
+                        await asyncio.wait_for(_consume(agent, f"benchmark query {i}"), timeout)
+                        latencies.append(time.perf_counter() - t1)
+                finally:
+                    wall = time.perf_counter() - t_all
+                    usage = agent.usage_summary()
+                    await agent.cleanup()
+
+                rounds = llm_server.requests - requests_before
+                llm_time = llm_server.busy_seconds - busy_before
+                tool_time = cfg.get("tool_latency", 0.0) * cfg["tool_depth"] * cfg["prompts"]
+                latencies.sort()
+                result.update({
+                    "prompts": cfg["prompts"],
+                    "llm_round_trips": rounds,
+                    "prompt_p50_ms": latencies[len(latencies) // 2] * 1000,
+                    "prompt_max_ms": latencies[-1] * 1000,
+                    "overhead_per_round_ms": max(0.0, wall - llm_time - tool_time) / max(1, rounds) * 1000,
+                    "throughput_prompts_per_s": cfg["prompts"] / wall if wall else 0.0,
+                    "prompt_tokens": usage["prompt_tokens"],
+                    "cache_hit_ratio": usage["cache_hit_ratio"],
+                })
+
+                t2 = time.perf_counter()
+                await asyncio.wait_for(run_interaction(
+                    user_query="one-shot benchmark query",
+                    mcp_config_path=config_path,
+                    log_messages_path=log_path,
+                    manifest_cache_path=manifests
+                ), timeout)
+                result["run_interaction_s"] = time.perf_counter() - t2
+
+                # 使用预热的服务器池：第一次调用启动服务器，第二次直接复用
+                pool = ServerPool()
+                try:
+                    for _ in range(2):
+                        t3 = time.perf_counter()
+                        await asyncio.wait_for(run_interaction(
+                            user_query="pooled one-shot benchmark query",
+                            mcp_config_path=config_path,
+                            log_messages_path=log_path,
+                            server_pool=pool,
+                            manifest_cache_path=manifests
+                        ), timeout)
+                    result["run_interaction_warm_s"] = time.perf_counter() - t3
+                finally:
+                    await pool.close()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result["py_peak_mb"] = peak / 2 ** 20
+            result["rss_delta_mb"] = _rss_mb() - rss_before
+            return result
+    except asyncio.TimeoutError:
+        return {**result, "error": f"timed out after {timeout}s"}
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        for p in sse_procs:
+            p.terminate()
+        await llm.close()
+        await llm_server.stop()
+
+
+def _print_table(results):
+    columns = ["scenario", "tools", "startup_s", "prompt_p50_ms", "overhead_per_round_ms",
+               "throughput_prompts_per_s", "cache_hit_ratio", "run_interaction_s", "run_interaction_warm_s", "py_peak_mb", "rss_delta_mb"]
+    print(" | ".join(columns))
+    for r in results:
+        if "error" in r or "skipped" in r:
+            print(f"{r['scenario']} | {r.get('error') or r.get('skipped')}")
+            continue
+        cells = []
+        for c in columns:
+            v = r.get(c, "")
+            cells.append(f"{v:.3f}" if isinstance(v, float) else str(v))
+        print(" | ".join(cells))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--stream", action="store_true", help="use streaming prompts")
+    parser.add_argument("--prompts", type=int, help="override the number of prompts per scenario")
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-step timeout in seconds")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        cfg = dict(SCENARIOS[name])
+        if args.prompts:
+            cfg["prompts"] = args.prompts
+        print(f"running {name} ...", file=sys.stderr)
+        results.append(await run_scenario(name, cfg, stream=args.stream, timeout=args.timeout))
+
+    _print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""
+JSON codec used on the hot paths (MCP stdio framing, tool arguments and
+results, payloads sent to the LLM, logs).
+
+Uses orjson or msgspec when installed and falls back to the stdlib json
+module. The backend can be forced with MY_MCP_JSON=orjson|msgspec|json.
+All encoders produce compact JSON; the *b variants work with bytes directly
+so transports and log files avoid a str -> bytes round trip. The fast
+backends emit UTF-8; the stdlib fallback escapes non-ASCII characters by
+default because that is its faster path.
+"""
+import json
+import os
+
+from typing import Any, Union
+
+BACKEND = "json"
+DecodeError = (ValueError,)
+
+_requested = os.getenv("MY_MCP_JSON", "").lower()
+
+_orjson = None
+_msgspec = None
+if _requested in ("", "orjson"):
+    try:
+        import orjson as _orjson
+        BACKEND = "orjson"
+    except ImportError:
+        _orjson = None
+if BACKEND == "json" and _requested in ("", "msgspec"):
+    try:
+        import msgspec as _msgspec
+        BACKEND = "msgspec"
+        _msgspec_encoder = _msgspec.json.Encoder()
+        _msgspec_sorted_encoder = _msgspec.json.Encoder(order="sorted")
+        _msgspec_decoder = _msgspec.json.Decoder()
+        DecodeError = (ValueError, _msgspec.DecodeError)
+    except (ImportError, TypeError):
+        _msgspec = None
+        BACKEND = "json"
+
+
+def _std_dumps(obj, sort_keys=False, indent=None, ensure_ascii=True) -> str:
+    separators = (",", ": ") if indent else (",", ":")
+    return json.dumps(obj, ensure_ascii=ensure_ascii, separators=separators, sort_keys=sort_keys, indent=indent)
+
+
+def dumpb(obj: Any, sort_keys: bool = False, ensure_ascii: bool = True) -> bytes:
+    """
+    Encode obj to compact JSON bytes. ensure_ascii only affects the stdlib
+    fallback; pass False where the output is read by people (logs).
+    """
+    try:
+        if _orjson is not None:
+            return _orjson.dumps(obj, option=_orjson.OPT_SORT_KEYS if sort_keys else 0)
+        if _msgspec is not None:
+            return (_msgspec_sorted_encoder if sort_keys else _msgspec_encoder).encode(obj)
+    except TypeError:
+        # 超出快速后端能力的对象（非字符串键、超大整数等）交给标准库
+        pass
+    return _std_dumps(obj, sort_keys=sort_keys, ensure_ascii=ensure_ascii).encode("utf-8")
+
+
+def dumps(obj: Any, sort_keys: bool = False, ensure_ascii: bool = True) -> str:
+    """Encode obj to a compact JSON string."""
+    if _orjson is None and _msgspec is None:
+        return _std_dumps(obj, sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+    return dumpb(obj, sort_keys=sort_keys).decode("utf-8")
+
+
+def dumps_pretty(obj: Any) -> str:
+    """Indented JSON for humans (console output, debug logs)."""
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(obj, option=_orjson.OPT_INDENT_2).decode("utf-8")
+        except TypeError:
+            pass
+    return _std_dumps(obj, indent=2, ensure_ascii=False)
+
+
+def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """Decode JSON from str or any bytes-like object; raises one of DecodeError."""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    if _msgspec is not None:
+        return _msgspec_decoder.decode(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
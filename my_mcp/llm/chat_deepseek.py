@@ -1,138 +1,300 @@
 from dotenv import load_dotenv
 import os
 
-import json
-from openai import AsyncOpenAI, APIError, RateLimitError
+import asyncio
+import importlib.util
+import logging
+import time
+
+import httpx
+from openai import AsyncOpenAI
+import codec
 from utils import clean_reasoning_content
+from llm.tools_payload import ToolsPayload
+from llm.stream_assembler import TextBuffer, JSONArgumentsAssembler
+from llm.scheduler import LLMScheduler, LLMRequestError, get_llm_scheduler
+from metrics import (LLM_REQUEST_SECONDS, LLM_TTFT_SECONDS, LLM_TOKENS_PER_SECOND,
+                     LLM_STREAM_CHUNKS_TOTAL, LLM_ERRORS_TOTAL, LLM_PROMPT_TOKENS_TOTAL,
+                     LLM_COMPLETION_TOKENS_TOTAL)
 
 load_dotenv()
 api_key = os.getenv("DS_API_KEY")
 base_url = os.getenv("DS_BASE_URL")
 
+logger = logging.getLogger("my_mcp")
+
 class ChatDeepSeek:
-    def __init__(self, api_key, base_url):
+    def __init__(self, api_key, base_url,
+                 max_connections = 100,
+                 max_keepalive_connections = 20,
+                 keepalive_expiry = 30.0,
+                 http2 = False,
+                 stream_usage = True,
+                 scheduler: LLMScheduler = None):
         self.model_name = "deepseek-reasoner"
         self.api_key = api_key
         self.base_url = base_url
+        # 连接池配置，客户端在多轮对话之间复用
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        # 流式请求也让服务端在最后返回 usage（包括上下文缓存命中的 token 数）
+        self.stream_usage = stream_usage
+        # 限流、重试和自适应并发；默认使用进程内共享的调度器
+        self._scheduler = scheduler
+        self._client = None
+
+    @property
+    def scheduler(self) -> LLMScheduler:
+        if self._scheduler is None:
+            self._scheduler = get_llm_scheduler()
+        return self._scheduler
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """Long-lived AsyncOpenAI client, created on first use and reused across turns."""
+        if self._client is None:
+            http2 = self.http2
+            if http2 and importlib.util.find_spec("h2") is None:
+                logger.warning("HTTP/2 requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+                http2 = False
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry
+                ),
+                http2=http2
+            )
+            # 重试由调度器负责（遵守 Retry-After 并在所有会话间协调），关闭客户端自带的重试
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                       http_client=http_client, max_retries=0)
+        return self._client
+
+    async def close(self):
+        """Close the pooled HTTP connections. A new client is created on next use."""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.close()
+
+    @staticmethod
+    def _text_chunk(pending: list) -> dict:
+        """Stream chunk carrying the buffered tokens; empties the buffer."""
+        text = "".join(pending)
+        pending.clear()
+        return {"assistant_text": text, "tool_calls": [], "is_chunk": True, "token": True}
+
+    @staticmethod
+    def _usage_dict(usage):
+        """
+        Token usage of one response, or None if the server sent none.
+
+        cache_hit_tokens is DeepSeek's prompt_cache_hit_tokens (falling back
+        to OpenAI's prompt_tokens_details.cached_tokens).
+        """
+        if usage is None:
+            return None
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        hit = getattr(usage, "prompt_cache_hit_tokens", None)
+        if hit is None:
+            hit = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if miss is None:
+            miss = max(0, prompt_tokens - hit)
+        result = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cache_hit_tokens": hit,
+            "cache_miss_tokens": miss
+        }
+        LLM_PROMPT_TOKENS_TOTAL.inc(hit, cache="hit")
+        LLM_PROMPT_TOKENS_TOTAL.inc(miss, cache="miss")
+        LLM_COMPLETION_TOKENS_TOTAL.inc(result["completion_tokens"])
+        return result
+
+    @staticmethod
+    def _estimate_tokens(conversation, tools_payload: ToolsPayload) -> int:
+        """Rough prompt size (about 3 characters per token) charged to the tokens-per-minute limit."""
+        chars = len(tools_payload.serialized)
+        for m in conversation:
+            content = m.get("content")
+            if isinstance(content, str):
+                chars += len(content)
+            for tc in m.get("tool_calls") or []:
+                chars += len(tc.get("function", {}).get("arguments") or "")
+        return chars // 3 + 1
+
+    @staticmethod
+    def _new_tool_call():
+        return {"id": "", "name": TextBuffer(), "arguments": JSONArgumentsAssembler()}
+
+    @staticmethod
+    def _tool_call_dict(tc, arguments: str):
+        return {"id": tc["id"], "function": {"name": tc["name"].text, "arguments": arguments}}
 
     async def generate_with_deepseek_stream(self, client: AsyncOpenAI, conversation,
-                                    formatted_functions):
-        """Internal function for streaming generation"""
+                                    tools_payload: ToolsPayload, flush_interval: float = 0.0):
+        """
+        Internal function for streaming generation.
+
+        Yields token chunks ({"is_chunk": True, "token": True}), a chunk with
+        "tool_call_done" for each tool call whose arguments are complete when
+        the model starts the next one, and a final chunk ({"is_chunk": False})
+        with the full text, every tool call, the token usage and the time to
+        first token. With flush_interval > 0 the tokens received within that
+        many seconds are yielded as one chunk; no token is held longer than
+        that, and buffered text is yielded before any tool call chunk.
+        """
+        start = time.perf_counter()
+        first_token_at = None
+        n_chunks = 0
+        final = None
         try:
-            response = await client.chat.completions.create(
-                model=self.model_name,
-                messages=conversation,
-                tools=[{"type": "function", "function": f} for f in formatted_functions],
-                tool_choice="auto",
-                stream=True
-            )
+            extra = {"stream_options": {"include_usage": True}} if self.stream_usage else {}
+            async with self.scheduler.lease(self._estimate_tokens(conversation, tools_payload)) as lease:
+                response = await lease.call(lambda: client.chat.completions.create(
+                    model=self.model_name,
+                    messages=conversation,
+                    tools=tools_payload.tools,
+                    tool_choice="auto",
+                    stream=True,
+                    **extra
+                ))
+
+                current_tool_calls = []
+                current_content = TextBuffer()
+                pending = [] # 尚未交给调用者的 token
+                last_flush = 0.0
+                usage = None
 
-            current_tool_calls = []
-            current_content = ""
-
-            async for chunk in response:
-                delta = chunk.choices[0].delta
-                
-                if delta.content:
-                    # Immediately yield each token without buffering
-                    yield {"assistant_text": delta.content, "tool_calls": [], "is_chunk": True, "token": True}
-                    current_content += delta.content
-
-                # Handle tool call updates
-                if delta.tool_calls:
-                    for tool_call in delta.tool_calls:
-                        # Initialize or update tool call
-                        while tool_call.index >= len(current_tool_calls):
-                            current_tool_calls.append({
-                                "id": "",
-                                "function": {
-                                    "name": "",
-                                    "arguments": ""
-                                }
-                            })
-                        
-                        current_tool = current_tool_calls[tool_call.index]
-                        
-                        # Update tool call properties
-                        if tool_call.id:
-                            current_tool["id"] = tool_call.id
-                        
-                        if tool_call.function.name:
-                            current_tool["function"]["name"] = (
-                                current_tool["function"]["name"] + tool_call.function.name
-                            )
-                        
-                        if tool_call.function.arguments:
-                            # Properly accumulate JSON arguments
-                            current_args = current_tool["function"]["arguments"]
-                            new_args = tool_call.function.arguments
-                            
-                            # Handle special cases for JSON accumulation
-                            if new_args.startswith("{") and not current_args:
-                                current_tool["function"]["arguments"] = new_args
-                            elif new_args.endswith("}") and current_args:
-                                # If we're receiving the end of the JSON object
-                                if not current_args.endswith("}"):
-                                    current_tool["function"]["arguments"] = current_args + new_args
-                            else:
-                                # Middle part of JSON - append carefully
-                                current_tool["function"]["arguments"] += new_args
-
-                # If this is the last chunk, yield final state with complete tool calls
-                if chunk.choices[0].finish_reason is not None:
-                    # Clean up and validate tool calls
-                    final_tool_calls = []
-                    for tc in current_tool_calls:
-                        if tc["id"] and tc["function"]["name"]:
+                iterator = response.__aiter__()
+                next_chunk = None
+                try:
+                    while True:
+                        if pending:
+                            # 有未输出的文本时最多等到 flush_interval 到期，之后先输出再继续等待
+                            next_chunk = asyncio.ensure_future(iterator.__anext__())
+                            timeout = last_flush + flush_interval - time.perf_counter()
+                            if timeout > 0:
+                                await asyncio.wait((next_chunk,), timeout=timeout)
+                            if not next_chunk.done():
+                                last_flush = time.perf_counter()
+                                yield self._text_chunk(pending)
                             try:
-                                # Ensure arguments is valid JSON
-                                args = tc["function"]["arguments"].strip()
-                                if not args or args.isspace():
-                                    args = "{}"
-                                # Parse and validate JSON
-                                parsed_args = json.loads(args)
-                                tc["function"]["arguments"] = json.dumps(parsed_args)
-                                final_tool_calls.append(tc)
-                            except json.JSONDecodeError:
-                                # If arguments are malformed, try to fix common issues
-                                args = tc["function"]["arguments"].strip()
-                                # Remove any trailing commas
-                                args = args.rstrip(",")
-                                # Ensure proper JSON structure
-                                if not args.startswith("{"):
-                                    args = "{" + args
-                                if not args.endswith("}"):
-                                    args = args + "}"
-                                try:
-                                    # Try parsing again after fixes
-                                    parsed_args = json.loads(args)
-                                    tc["function"]["arguments"] = json.dumps(parsed_args)
-                                    final_tool_calls.append(tc)
-                                except json.JSONDecodeError:
-                                    # If still invalid, default to empty object
-                                    tc["function"]["arguments"] = "{}"
-                                    final_tool_calls.append(tc)
-
-                    yield {
-                        "assistant_text": current_content,
-                        "tool_calls": final_tool_calls,
-                        "is_chunk": False
-                    }
+                                chunk = await next_chunk
+                            except StopAsyncIteration:
+                                break
+                            finally:
+                                next_chunk = None
+                        else:
+                            try:
+                                chunk = await iterator.__anext__()
+                            except StopAsyncIteration:
+                                break
+
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = chunk.usage
+                        if not chunk.choices:
+                            # include_usage 时最后一个 chunk 只有 usage
+                            continue
+                        delta = chunk.choices[0].delta
+                        if first_token_at is None and (delta.content or delta.tool_calls):
+                            first_token_at = time.perf_counter()
+                            LLM_TTFT_SECONDS.observe(first_token_at - start)
+
+                        if delta.content:
+                            n_chunks += 1
+                            current_content.append(delta.content)
+                            pending.append(delta.content)
+                            now = time.perf_counter()
+                            if now - last_flush >= flush_interval:
+                                last_flush = now
+                                yield self._text_chunk(pending)
+
+                        # Handle tool call updates
+                        if delta.tool_calls:
+                            # 模型转入工具调用前输出的文本不再等待后续 token
+                            if pending:
+                                last_flush = time.perf_counter()
+                                yield self._text_chunk(pending)
+                            for tool_call in delta.tool_calls:
+                                if tool_call.index >= len(current_tool_calls) > 0:
+                                    # 模型开始输出下一个工具调用，上一个的参数已完整，可以提前执行
+                                    previous = current_tool_calls[-1]
+                                    if previous["id"] and previous["name"].length and previous["arguments"].is_complete:
+                                        done = self._tool_call_dict(previous, previous["arguments"].finish())
+                                        yield {"assistant_text": "", "tool_calls": [done], "is_chunk": True,
+                                               "tool_call_done": len(current_tool_calls) - 1}
+                                while tool_call.index >= len(current_tool_calls):
+                                    current_tool_calls.append(self._new_tool_call())
+                                current_tool = current_tool_calls[tool_call.index]
+                                if tool_call.id:
+                                    current_tool["id"] = tool_call.id
+                                if tool_call.function.name:
+                                    current_tool["name"].append(tool_call.function.name)
+                                if tool_call.function.arguments:
+                                    current_tool["arguments"].feed(tool_call.function.arguments)
+
+                        # If this is the last chunk, yield final state with complete tool calls
+                        if chunk.choices[0].finish_reason is not None:
+                            end = time.perf_counter()
+                            LLM_REQUEST_SECONDS.observe(end - start, mode="stream")
+                            LLM_STREAM_CHUNKS_TOTAL.inc(n_chunks)
+                            if first_token_at is not None and n_chunks > 1 and end > first_token_at:
+                                LLM_TOKENS_PER_SECOND.observe(n_chunks / (end - first_token_at))
+                            if pending:
+                                yield self._text_chunk(pending)
+                            # 参数不完整（例如被截断）时 finish() 返回 "{}"，不使用截断的参数
+                            final_tool_calls = [
+                                self._tool_call_dict(tc, tc["arguments"].finish())
+                                for tc in current_tool_calls if tc["id"] and tc["name"].length
+                            ]
+                            final = {
+                                "assistant_text": current_content.text,
+                                "tool_calls": final_tool_calls,
+                                "is_chunk": False,
+                                "ttft": (first_token_at - start) if first_token_at is not None else None
+                            }
+                finally:
+                    if next_chunk is not None:
+                        next_chunk.cancel()
+
+                # usage 在 finish_reason 之后的最后一个 chunk 中
+                if final is not None:
+                    final["usage"] = self._usage_dict(usage)
+                    if final["usage"]:
+                        lease.settle(final["usage"]["prompt_tokens"] + final["usage"]["completion_tokens"])
+
+            # 调用者处理最终结果（执行工具）时不再占用并发名额
+            if final is not None:
+                yield final
 
+        except LLMRequestError as e:
+            LLM_ERRORS_TOTAL.inc(mode="stream", error=type(e.__cause__ or e).__name__)
+            raise
         except Exception as e:
-            yield {"assistant_text": f"OpenAI error: {str(e)}", "tool_calls": [], "is_chunk": False}
+            # 流已经开始后出错：已输出的内容无法撤回，不再重试
+            LLM_ERRORS_TOTAL.inc(mode="stream", error=type(e).__name__)
+            raise LLMRequestError(f"LLM stream failed: {str(e)}", status=getattr(e, "status_code", None)) from e
 
     async def generate_with_deepseek_sync(self, client: AsyncOpenAI, conversation, 
-                                    formatted_functions):
+                                    tools_payload: ToolsPayload):
         """Internal function for non-streaming generation"""
+        start = time.perf_counter()
         try:
-            response = await client.chat.completions.create(
-                model=self.model_name,
-                messages=conversation,
-                tools=[{"type": "function", "function": f} for f in formatted_functions],
-                tool_choice="auto",
-                stream=False
-            )
+            async with self.scheduler.lease(self._estimate_tokens(conversation, tools_payload)) as lease:
+                response = await lease.call(lambda: client.chat.completions.create(
+                    model=self.model_name,
+                    messages=conversation,
+                    tools=tools_payload.tools,
+                    tool_choice="auto",
+                    stream=False
+                ))
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, mode="sync")
+                usage = self._usage_dict(getattr(response, "usage", None))
+                if usage:
+                    lease.settle(usage["prompt_tokens"] + usage["completion_tokens"])
 
             choice = response.choices[0]
             assistant_text = choice.message.content or ""
@@ -150,41 +312,56 @@ class ChatDeepSeek:
                         }
                         # Ensure arguments is valid JSON
                         try:
-                            json.loads(tool_call["function"]["arguments"])
-                        except json.JSONDecodeError:
+                            codec.loads(tool_call["function"]["arguments"])
+                        except codec.DecodeError:
                             tool_call["function"]["arguments"] = "{}"
                         tool_calls.append(tool_call)
-            return {"assistant_text": assistant_text, "tool_calls": tool_calls}
+            return {"assistant_text": assistant_text, "tool_calls": tool_calls, "usage": usage}
 
-        except APIError as e:
-            return {"assistant_text": f"OpenAI API error: {str(e)}", "tool_calls": []}
-        except RateLimitError as e:
-            return {"assistant_text": f"OpenAI rate limit: {str(e)}", "tool_calls": []}
-        except Exception as e:
-            return {"assistant_text": f"Unexpected OpenAI error: {str(e)}", "tool_calls": []}
+        except LLMRequestError as e:
+            # 错误不再作为回答文本返回，由调用者处理
+            LLM_ERRORS_TOTAL.inc(mode="sync", error=type(e.__cause__ or e).__name__)
+            raise
+
+    async def summarize(self, messages, max_chars = 20000):
+        """Summarize earlier messages into a short note used by context compaction."""
+        lines = []
+        for m in messages:
+            content = m.get("content") or ""
+            for tc in m.get("tool_calls") or []:
+                content += f" [calls {tc['function']['name']}({tc['function'].get('arguments', '')})]"
+            lines.append(f"{m['role']}: {content}")
+        transcript = "\n".join(lines)[-max_chars:]
+        client = self.client
+        async with self.scheduler.lease(len(transcript) // 3) as lease:
+            response = await lease.call(lambda: client.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "Summarize the following conversation between a user, an assistant and its tools. "
+                                                  "Keep facts, decisions, file names and open questions; be concise."},
+                    {"role": "user", "content": transcript}
+                ],
+                stream=False
+            ))
+        return response.choices[0].message.content or ""
 
     async def get_deepseek_response(self, conversation,
-                                all_functions, stream = False):
-        client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+                                all_functions, stream = False, flush_interval = 0.0):
+        client = self.client
 
-        formatted_functions = []
-        for func in all_functions:
-            formatted_func = {
-                "name": func["name"],
-                "description": func["description"],
-                "parameters": func["parameters"]
-            }
-            formatted_functions.append(formatted_func)
+        # all_functions 可以是预先构建好的 ToolsPayload（MCPAgent 会缓存），也可以是普通列表
+        tools_payload = ToolsPayload.ensure(all_functions)
 
-        clean_reasoning_content(conversation)
+        # 不修改调用者的对话历史，请求前缀在多轮之间保持不变
+        conversation = clean_reasoning_content(conversation)
 
         if stream:
             return self.generate_with_deepseek_stream(
-                client, conversation, formatted_functions
+                client, conversation, tools_payload, flush_interval
             )
         else:
             return await self.generate_with_deepseek_sync(
-                client, conversation, formatted_functions
+                client, conversation, tools_payload
             )
             
 
@@ -0,0 +1,299 @@
+import asyncio
+import collections
+import contextlib
+import email.utils
+import os
+import random
+import time
+
+from typing import Awaitable, Callable, Optional
+
+import logging
+
+from openai import APIConnectionError, APIStatusError
+
+from metrics import LLM_RETRIES_TOTAL, LLM_SCHEDULER_WAIT_SECONDS
+
+logger = logging.getLogger("my_mcp")
+
+
+class LLMRequestError(Exception):
+    """An LLM request that failed for good (not retryable, or out of retries)."""
+    def __init__(self, message: str, status: Optional[int] = None, attempts: int = 1):
+        super().__init__(message)
+        self.status = status
+        self.attempts = attempts
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at per_minute / 60 tokens per second, holding at
+    most one minute's worth. adjust() settles the difference between an
+    estimate that was taken and the real cost, so the level may go below
+    zero and later requests wait for the debt to be paid off.
+    """
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        # 超过容量的请求按容量计，避免永远等不到
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class _Lease:
+    __slots__ = ("scheduler", "estimated_tokens", "attempts")
+
+    def __init__(self, scheduler, estimated_tokens: int):
+        self.scheduler = scheduler
+        self.estimated_tokens = estimated_tokens
+        self.attempts = 0
+
+    async def call(self, create: Callable[[], Awaitable]):
+        """
+        Await create() within the rate limits, retrying retryable failures
+        with jittered exponential backoff (or the server's Retry-After).
+        Raises LLMRequestError when the request fails for good.
+        """
+        scheduler = self.scheduler
+        while True:
+            self.attempts += 1
+            await scheduler._wait_budget(self.estimated_tokens)
+            try:
+                result = await create()
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                retryable = scheduler.is_retryable(e)
+                delay = scheduler._retry_delay(e, self.attempts) if retryable else None
+                too_long = retryable and (scheduler.retry_after(e) or 0) > scheduler.max_retry_after
+                if status == 429:
+                    # 其它请求同样暂停，但最多暂停 max_retry_after，不让整个进程长时间阻塞
+                    scheduler._on_throttled(min(delay, scheduler.max_retry_after))
+                if not retryable or self.attempts > scheduler.max_retries or too_long:
+                    if not retryable:
+                        reason = "not retryable"
+                    elif self.attempts > scheduler.max_retries:
+                        reason = "giving up"
+                    else:
+                        reason = f"server asked to retry after {delay:.0f}s"
+                    raise LLMRequestError(f"LLM request failed after {self.attempts} attempt(s) ({reason}): {str(e)}",
+                                          status=status, attempts=self.attempts) from e
+                LLM_RETRIES_TOTAL.inc(reason=str(status or type(e).__name__))
+                logger.warning(f"LLM request failed ({status or type(e).__name__}), "
+                               f"retry {self.attempts}/{scheduler.max_retries} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            scheduler._on_success()
+            return result
+
+    def settle(self, actual_tokens: int):
+        """Charge the real token count reported by the server instead of the estimate."""
+        if actual_tokens and self.scheduler._tokens is not None:
+            self.scheduler._tokens.adjust(self.estimated_tokens - actual_tokens)
+
+
+class LLMScheduler:
+    """
+    Process-wide scheduler for LLM requests.
+
+    Every request takes a concurrency slot, one request from the
+    requests-per-minute bucket and its estimated tokens from the
+    tokens-per-minute bucket (both optional). Failed requests are retried
+    with full-jitter exponential backoff, or after the server's
+    Retry-After. A Retry-After longer than max_retry_after fails the
+    request immediately instead of blocking it that long. The concurrency
+    limit adapts (AIMD): a 429 halves it and pauses new requests for the
+    Retry-After period (at most max_retry_after), each success raises it
+    by 1/limit up to max_concurrency.
+    """
+    def __init__(self,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_concurrency: int = 16,
+                 min_concurrency: int = 1,
+                 max_retries: int = 5,
+                 base_delay: float = 0.5,
+                 max_delay: float = 30.0,
+                 max_retry_after: float = 120.0):
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(min_concurrency, int(max_concurrency))
+        self.limit = float(self.max_concurrency)
+        self._requests = None
+        self._tokens = None
+        self._active = 0
+        self._waiters = collections.deque()
+        self.configure(requests_per_minute, tokens_per_minute)
+        self._resume_at = 0.0 # 429 之后暂停发送新请求直到该时间
+        self.throttled = 0
+
+    def configure(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                  max_concurrency: Optional[int] = None):
+        """Change the limits; None keeps the current value, a rate of 0 removes that limit."""
+        if requests_per_minute is not None:
+            self._requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        if tokens_per_minute is not None:
+            self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        if max_concurrency is not None:
+            self.max_concurrency = max(self.min_concurrency, int(max_concurrency))
+            self.limit = float(self.max_concurrency)
+            self._wake()
+
+    # ---- concurrency ---- #
+    async def _acquire_slot(self):
+        while self._active >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # 被唤醒后又被取消时把机会让给下一个等待者
+                self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._active += 1
+
+    def _release_slot(self):
+        self._active -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self._active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    @contextlib.asynccontextmanager
+    async def lease(self, estimated_tokens: int = 0):
+        """
+        Hold a concurrency slot for one request (for a streamed response,
+        until the stream is consumed). Use lease.call() to send it.
+        """
+        start = time.perf_counter()
+        await self._acquire_slot()
+        LLM_SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - start)
+        try:
+            yield _Lease(self, estimated_tokens)
+        finally:
+            self._release_slot()
+
+    # ---- rate limits ---- #
+    async def _wait_budget(self, estimated_tokens: int):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._requests is not None:
+            await self._requests.acquire(1)
+        if self._tokens is not None and estimated_tokens:
+            await self._tokens.acquire(estimated_tokens)
+
+    def _on_throttled(self, delay: float):
+        self.throttled += 1
+        self.limit = max(float(self.min_concurrency), self.limit / 2)
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        logger.warning(f"LLM rate limited, concurrency limit lowered to {int(self.limit)}")
+
+    def _on_success(self):
+        if self.limit < self.max_concurrency:
+            self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._wake()
+
+    # ---- retries ---- #
+    @staticmethod
+    def is_retryable(e: Exception) -> bool:
+        if isinstance(e, APIStatusError):
+            return e.status_code in (408, 409, 429) or e.status_code >= 500
+        # APITimeoutError 是 APIConnectionError 的子类
+        return isinstance(e, APIConnectionError)
+
+    @staticmethod
+    def retry_after(e: Exception) -> Optional[float]:
+        """Seconds from the Retry-After (or retry-after-ms) header of a failed response, if any."""
+        headers = getattr(getattr(e, "response", None), "headers", None)
+        if not headers:
+            return None
+        value = headers.get("retry-after-ms")
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _retry_delay(self, e: Exception, attempt: int) -> float:
+        retry_after = self.retry_after(e)
+        if retry_after is not None and retry_after >= 0:
+            # 在服务器要求的时间上加少量抖动，避免所有会话同时重试
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "concurrency_limit": int(self.limit),
+            "max_concurrency": self.max_concurrency,
+            "throttled": self.throttled
+        }
+
+
+_default_scheduler = None
+
+
+def _env_number(name):
+    value = os.getenv(name)
+    try:
+        return float(value) if value else None
+    except ValueError:
+        logger.warning(f"Ignoring invalid {name}={value!r}")
+        return None
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """
+    The shared, process-wide scheduler. Its initial limits come from
+    DS_REQUESTS_PER_MINUTE, DS_TOKENS_PER_MINUTE and DS_MAX_CONCURRENCY.
+    """
+    global _default_scheduler
+    if _default_scheduler is None:
+        concurrency = _env_number("DS_MAX_CONCURRENCY")
+        _default_scheduler = LLMScheduler(
+            requests_per_minute=_env_number("DS_REQUESTS_PER_MINUTE"),
+            tokens_per_minute=_env_number("DS_TOKENS_PER_MINUTE"),
+            max_concurrency=int(concurrency) if concurrency else 16
+        )
+    return _default_scheduler
@@ -0,0 +1,124 @@
+import re
+
+from typing import List, Optional
+
+import codec
+
+# 参数片段中需要关注的字符，其余字符整段跳过
+_SPECIAL_RE = re.compile(r'[\\"{}\[\]]')
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class TextBuffer:
+    """Append-only text buffer; joins the parts only when the text is read."""
+    __slots__ = ("_parts", "_text", "length")
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._text = ""
+        self.length = 0
+
+    def append(self, text: str):
+        if text:
+            self._parts.append(text)
+            self.length += len(text)
+
+    @property
+    def text(self) -> str:
+        if self._parts:
+            self._text += "".join(self._parts)
+            self._parts.clear()
+        return self._text
+
+    def __len__(self):
+        return self.length
+
+
+class JSONArgumentsAssembler:
+    """
+    Incremental assembler for the streamed arguments of one tool call.
+
+    Fragments are concatenated exactly as received. A small scanner tracks
+    string, escape and bracket state across fragments so completeness is
+    known without re-parsing: is_complete is true once the top-level value
+    has been closed. finish() returns the final argument string, or "{}"
+    when a truncated stream left it incomplete.
+    """
+    __slots__ = ("_buffer", "_stack", "_in_string", "_escape", "_closed", "_invalid", "_valid")
+
+    def __init__(self):
+        self._buffer = TextBuffer()
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._closed = False
+        self._invalid = False
+        self._valid: Optional[bool] = None # 完整时解析校验的结果（缓存）
+
+    def feed(self, fragment: str):
+        if not fragment:
+            return
+        self._buffer.append(fragment)
+        self._valid = None
+        if self._invalid:
+            return
+        escape_at = 0 if self._escape else -1
+        self._escape = False
+        for m in _SPECIAL_RE.finditer(fragment):
+            i = m.start()
+            if i == escape_at:
+                continue
+            ch = m.group()
+            if self._in_string:
+                if ch == "\\":
+                    escape_at = i + 1
+                    self._escape = escape_at == len(fragment)
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if self._closed:
+                # 顶层值结束后又出现了内容
+                self._invalid = True
+                return
+            if ch == '"':
+                self._in_string = True
+            elif ch in _CLOSERS:
+                self._stack.append(_CLOSERS[ch])
+            elif ch != "\\":
+                if not self._stack or self._stack.pop() != ch:
+                    self._invalid = True
+                    return
+                if not self._stack:
+                    self._closed = True
+
+    @property
+    def text(self) -> str:
+        return self._buffer.text
+
+    @property
+    def is_complete(self) -> bool:
+        """The top-level object/array is closed and parses as JSON."""
+        if not self._closed or self._invalid:
+            return False
+        if self._valid is None:
+            self._valid = self._parses(self.text.strip())
+        return self._valid
+
+    @staticmethod
+    def _parses(text: str) -> bool:
+        try:
+            codec.loads(text)
+            return True
+        except codec.DecodeError:
+            return False
+
+    def finish(self) -> str:
+        """The argument string to send back to the model and to the tool ("{}" if unusable)."""
+        text = self.text.strip()
+        if not text:
+            return "{}"
+        if self.is_complete:
+            return text
+        # 流被截断（例如 finish_reason 为 length）时不补全：补出来的参数是模型没有给出的，
+        # 可能让工具带着半截内容执行；返回 "{}" 让工具的参数校验失败
+        return text if self._parses(text) else "{}"
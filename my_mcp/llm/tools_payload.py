@@ -0,0 +1,47 @@
+import hashlib
+
+from typing import List, Dict
+
+import codec
+
+
+class ToolsPayload:
+    """
+    Pre-built `tools` argument for chat.completions requests.
+
+    Wrapping every function definition into {"type": "function", ...} and
+    serializing it is done once here instead of on every turn; the agent only
+    builds a new payload when its tool set changes.
+
+    The payload is canonical so that the request prefix the provider caches
+    stays byte-identical: functions are sorted by name, whatever order the
+    servers started or listed them in, and every object's keys are sorted.
+    """
+    def __init__(self, functions: List[Dict]):
+        self.functions = sorted(functions, key=lambda f: f["name"])
+        tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": f["name"],
+                    "description": f["description"],
+                    "parameters": f["parameters"]
+                }
+            }
+            for f in self.functions
+        ]
+        data = codec.dumpb(tools, sort_keys=True)
+        # 重新解析得到按键排序的字典，openai 客户端序列化时保持同样的顺序
+        self.tools = codec.loads(data)
+        self.serialized = data.decode("utf-8")
+        self.fingerprint = hashlib.sha256(data).hexdigest()
+
+    def __len__(self):
+        return len(self.tools)
+
+    @classmethod
+    def ensure(cls, functions):
+        """Return functions unchanged if it already is a payload, otherwise build one."""
+        if isinstance(functions, cls):
+            return functions
+        return cls(functions)
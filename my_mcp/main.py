@@ -1,5 +1,7 @@
 from process_mcp.agent import run_interaction
 from process_mcp.agent import MCPAgent
+from process_mcp.agent import aclose_default_llm
+from llm.scheduler import LLMRequestError
 
 import asyncio
 
@@ -57,9 +59,12 @@ async def main():
 
                 response_generator = await agent.prompt(current_query)
                 full_response = ""
-                async for chunk in response_generator:
-                    print(chunk, end="", flush=True)
-                    full_response += chunk
+                try:
+                    async for chunk in response_generator:
+                        print(chunk, end="", flush=True)
+                        full_response += chunk
+                except LLMRequestError as e:
+                    print(f"\n[ERROR] {e}")
                 print() # Add a newline after the full response
                 
                 # In a real chat, we might add full_response to a history
@@ -67,12 +72,19 @@ async def main():
 
         finally:
             await agent.cleanup()
+            await aclose_default_llm()
             logger.debug("Agent cleaned up.")
     else:
         user_query = input("请输入你的问题：")
-        response = await run_interaction(user_query=user_query,
-                            mcp_config_path=mcp_config_path,
-                            log_messages_path=log_path)
+        try:
+            response = await run_interaction(user_query=user_query,
+                                mcp_config_path=mcp_config_path,
+                                log_messages_path=log_path)
+        except LLMRequestError as e:
+            print(f"[ERROR] {e}")
+            return
+        finally:
+            await aclose_default_llm()
 
         print(r"\n" + response.strip() + "\n")
 
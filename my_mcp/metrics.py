@@ -0,0 +1,221 @@
+import bisect
+import threading
+import time
+
+from typing import Dict, Tuple
+
+# 默认的延迟分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def snapshot(self):
+        return {",".join(key) or "": value for key, value in sorted(self._values.items())}
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, n_buckets):
+        self.counts = [0] * (n_buckets + 1) # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            hv = self._values.get(key)
+            if hv is None:
+                hv = self._values[key] = _HistogramValue(len(self.buckets))
+            hv.counts[index] += 1
+            hv.sum += value
+            hv.count += 1
+
+    def time(self, **labels):
+        """Context manager observing the elapsed wall time of its block."""
+        return _Timer(self, labels)
+
+    def _quantile(self, hv: _HistogramValue, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside the matching bucket."""
+        if not hv.count:
+            return 0.0
+        rank = q * hv.count
+        seen = 0
+        for i, c in enumerate(hv.counts):
+            if seen + c >= rank and c:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * ((rank - seen) / c)
+            seen += c
+        return self.buckets[-1]
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, hv in sorted(self._values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, hv.counts):
+                cumulative += c
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {hv.count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {hv.sum}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {hv.count}")
+        return lines
+
+    def snapshot(self):
+        result = {}
+        for key, hv in sorted(self._values.items()):
+            result[",".join(key) or ""] = {
+                "count": hv.count,
+                "sum": hv.sum,
+                "mean": hv.sum / hv.count if hv.count else 0.0,
+                "p50": self._quantile(hv, 0.5),
+                "p90": self._quantile(hv, 0.9),
+                "p99": self._quantile(hv, 0.99)
+            }
+        return result
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """
+    Process-wide registry of counters and histograms.
+
+    Metrics are plain in-memory aggregates (a dict lookup and a few additions
+    per observation), so they stay enabled in production. Export with
+    to_prometheus() or snapshot().
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].prometheus())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        return {name: self._metrics[name].snapshot() for name in sorted(self._metrics)}
+
+
+metrics = MetricsRegistry()
+
+# ---- metrics used across the agent ---- #
+TOOL_CALL_SECONDS = metrics.histogram(
+    "mcp_tool_call_seconds", "Latency of MCP tool calls", ("server", "transport"))
+TOOL_CALLS_TOTAL = metrics.counter(
+    "mcp_tool_calls_total", "MCP tool calls by outcome", ("server", "transport", "status"))
+CIRCUIT_OPEN_TOTAL = metrics.counter(
+    "mcp_circuit_open_total", "Times a server's circuit breaker opened after repeated timeouts", ("server",))
+MCP_REQUEST_SECONDS = metrics.histogram(
+    "mcp_request_seconds", "Latency of MCP initialize and tools/list requests", ("server", "method"))
+
+LLM_REQUEST_SECONDS = metrics.histogram(
+    "llm_request_seconds", "Total duration of LLM requests", ("mode",))
+LLM_TTFT_SECONDS = metrics.histogram(
+    "llm_time_to_first_token_seconds", "Time until the first streamed token or tool call delta")
+LLM_TOKENS_PER_SECOND = metrics.histogram(
+    "llm_stream_tokens_per_second", "Streamed chunks per second after the first token",
+    buckets=(1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400))
+LLM_STREAM_CHUNKS_TOTAL = metrics.counter(
+    "llm_stream_chunks_total", "Content chunks received from streaming responses")
+LLM_PROMPT_TOKENS_TOTAL = metrics.counter(
+    "llm_prompt_tokens_total", "Prompt tokens reported by the provider, by context cache outcome", ("cache",))
+LLM_COMPLETION_TOKENS_TOTAL = metrics.counter(
+    "llm_completion_tokens_total", "Completion tokens reported by the provider")
+LLM_RETRIES_TOTAL = metrics.counter(
+    "llm_retries_total", "LLM requests retried by the scheduler, by HTTP status or error", ("reason",))
+LLM_SCHEDULER_WAIT_SECONDS = metrics.histogram(
+    "llm_scheduler_wait_seconds", "Time LLM requests waited for a concurrency slot")
+LLM_ERRORS_TOTAL = metrics.counter(
+    "llm_errors_total", "Failed LLM requests", ("mode", "error"))
+
+PROMPT_SECONDS = metrics.histogram(
+    "agent_prompt_seconds", "Duration of MCPAgent.prompt from user query to final answer", ("mode",))
+TOOL_CALLS_EARLY_TOTAL = metrics.counter(
+    "agent_tool_calls_early_dispatched_total", "Streamed tool calls started before the response finished")
+TOOLS_PER_REQUEST = metrics.histogram(
+    "agent_tools_per_request", "Tools sent with each LLM request after relevance subsetting",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+PROMPT_ITERATIONS = metrics.histogram(
+    "agent_prompt_loop_iterations", "LLM round trips per prompt", ("mode",),
+    buckets=(1, 2, 3, 4, 5, 8, 12, 16, 24, 32))
+
+SERVICE_REQUESTS_TOTAL = metrics.counter(
+    "service_requests_total", "Prompts handled by the multi-session service by outcome", ("transport", "status"))
+SERVICE_QUEUE_SECONDS = metrics.histogram(
+    "service_queue_wait_seconds", "Time prompts waited for a free slot in the service")
+
+BATCH_ITEMS_TOTAL = metrics.counter(
+    "batch_items_total", "Items handled by the batch runner by outcome", ("status",))
+BATCH_ITEM_SECONDS = metrics.histogram(
+    "batch_item_seconds", "Time to answer one batch item, including agent setup")
@@ -3,14 +3,26 @@ from dotenv import load_dotenv
 import os
 
 from typing import List, Dict
-import json
+import asyncio
+import collections
+import time
 
 import logging
 
+import codec
 from utils import load_config_from_file
 from process_mcp.transport import StdioMCP
-from process_mcp.transport import SSEMCP
-from utils import clean_reasoning_content
+from process_mcp.pool import create_client, start_server, config_key, ServerPool
+from llm.tools_payload import ToolsPayload
+from process_mcp.tool_cache import ToolResultCache
+from process_mcp.context import ContextManager, estimate_tokens
+from process_mcp.blob_store import BlobStore
+from process_mcp.log_writer import ConversationLogWriter
+from process_mcp.manifest_cache import ToolManifestCache, LazyServer
+from process_mcp.tool_index import ToolIndex
+from metrics import PROMPT_SECONDS, PROMPT_ITERATIONS, TOOLS_PER_REQUEST, TOOL_CALLS_EARLY_TOTAL
+
+_USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "cache_hit_tokens", "cache_miss_tokens")
 
 logger = logging.getLogger('my_mcp')
 
@@ -20,36 +32,21 @@ base_url = os.getenv("DS_BASE_URL")
 
 llm = ChatDeepSeek(api_key=api_key, base_url=base_url)
 
-async def log_messages_to_file(messages: List[Dict], functions: List[Dict], log_path: str):
+async def aclose_default_llm():
     """
-    Log messages and function definitions to a JSONL file.
-
-    Args:
-        messages: List of messages to log
-        functions: List of function definitions
-        log_path: Path to the log file
+    Close the module-level LLM client shared by agents created without
+    llm_client. Call once when the process is done with agents (e.g. at
+    exit); agents never close it themselves.
     """
-    try:
-        # Create directory if it doesn't exist
-        log_dir = os.path.dirname(log_path)
-        if log_dir and not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-
-        # Append to file
-        with open(log_path, "a") as f:
-            f.write(json.dumps({
-                "messages": messages,
-                "functions": functions
-            }) + "\n")
-    except Exception as e:
-        logger.error(f"Error logging messages to {log_path}: {str(e)}")
-
-async def process_tool_call(tc, servers: Dict[str, StdioMCP]):
+    await llm.close()
+
+async def process_tool_call(tc, servers: Dict[str, StdioMCP], tool_cache: ToolResultCache = None,
+                            blob_store: BlobStore = None, verbose = True):
     func_name = tc["function"]["name"]
     func_args_str = tc["function"].get("arguments", "{}")
     try:
-        func_args = json.loads(func_args_str)
-    except:
+        func_args = codec.loads(func_args_str)
+    except codec.DecodeError + (TypeError,):
         func_args = {}
     
     parts = func_name.split("_", 1)
@@ -58,17 +55,18 @@ async def process_tool_call(tc, servers: Dict[str, StdioMCP]):
             "role": "tool",
             "tool_call_id": tc["id"],
             "name": func_name,
-            "content": json.dumps({"error": "Invalid function name format"})
+            "content": codec.dumps({"error": "Invalid function name format"})
         }
     srv_name, tool_name = parts
-    print(f"\nView result from {tool_name} from {srv_name} {json.dumps(func_args)}")
+    if verbose:
+        print(f"\nView result from {tool_name} from {srv_name} {codec.dumps(func_args)}")
 
     if srv_name not in servers:
         return {
             "role": "tool",
             "tool_call_id": tc["id"],
             "name": func_name,
-            "content": json.dumps({"error": f"Unknown server: {srv_name}"})
+            "content": codec.dumps({"error": f"Unknown server: {srv_name}"})
         }
     
     # Get the tool's schema
@@ -87,31 +85,58 @@ async def process_tool_call(tc, servers: Dict[str, StdioMCP]):
                     "role": "tool",
                     "tool_call_id": tc["id"],
                     "name": func_name,
-                    "content": json.dumps({"error": f"Missing required parameter: {param}"})
+                    "content": codec.dumps({"error": f"Missing required parameter: {param}"})
                 }
             
-    result = await servers[srv_name].call_tool(tool_name, func_args)
-    print(json.dumps(result, indent=2))
+    if tool_cache is not None:
+        result = await tool_cache.call(srv_name, tool_name, func_args, servers[srv_name].call_tool)
+    else:
+        result = await servers[srv_name].call_tool(tool_name, func_args)
+
+    content = codec.dumps(result)
+    spilled = False
+    if blob_store is not None:
+        # 超大结果写入 blob store，对话中只保留预览和引用
+        stored = await blob_store.spill(content)
+        spilled = stored is not content
+        content = stored
+    if verbose:
+        print(content if spilled else codec.dumps_pretty(result))
 
     return {
         "role": "tool",
         "tool_call_id": tc["id"],
         "name": func_name,
-        "content": json.dumps(result)
+        "content": content
     }
 
+def tools_to_functions(server_name: str, tools: List[Dict]) -> List[Dict]:
+    """Convert the MCP tools of one server into LLM function definitions."""
+    functions = []
+    for t in tools:
+        input_schema = t.get("inputSchema") or {"type": "object", "properties": {}}
+        functions.append({
+            "name": f"{server_name}_{t['name']}",
+            "description": t.get("description", ""),
+            "parameters": input_schema
+        })
+    return functions
+
 # __init__ 是同步方法，通过@classmethod + create，可以使用异步初始化（如果需要在初始化中加载配置之类的
 class MCPAgent:
     @classmethod
     async def create(cls, 
                      mcp_server_config_path,
                      log_messages_path,
-                     stream = False):
+                     stream = False,
+                     **options):
+        """Create and initialize an agent; options are the keyword arguments of _initialize."""
         obj = cls()
         await obj._initialize(
             mcp_server_config_path=mcp_server_config_path,
             log_messages_path=log_messages_path,
-            stream=stream
+            stream=stream,
+            **options
         )
         return obj
     
@@ -121,159 +146,585 @@ class MCPAgent:
     async def _initialize(self, 
                           mcp_server_config_path,
                           log_messages_path,
-                          stream = False):
+                          stream = False,
+                          startup_timeout = 30,
+                          parallel_tool_calls = True,
+                          max_tool_concurrency = 4,
+                          tool_cache = None,
+                          context_token_budget = 48000,
+                          summarize_history = False,
+                          blob_threshold = 64 * 1024,
+                          blob_store_path = None,
+                          blob_max_bytes = 1024 ** 3,
+                          blob_max_age = 7 * 24 * 3600,
+                          log_max_bytes = 10 * 1024 * 1024,
+                          log_compress = False,
+                          server_pool: ServerPool = None,
+                          llm_client: ChatDeepSeek = None,
+                          lazy_start = True,
+                          manifest_cache_path = None,
+                          manifest_revalidate_after = 300,
+                          tool_top_k = 16,
+                          tool_subset_threshold = 40,
+                          stream_flush_interval = 0.05,
+                          usage_history = 1000,
+                          verbose = True):
         self.stream = stream
+        # 流式输出时，这段时间（秒）内到达的 token 合并为一次输出；0 表示逐 token 输出
+        self.stream_flush_interval = stream_flush_interval
+        # LLM 客户端由所有者负责关闭：传入的客户端由调用者关闭，模块级客户端被进程内所有 agent 共享，
+        # 不在 cleanup 时关闭，进程结束前调用 aclose_default_llm()
+        self.llm = llm_client if llm_client is not None else llm
+        # verbose=False 时不向 stdout 打印启动和工具调用信息（服务模式）
+        self.verbose = verbose
+        # 传入 server_pool 时从共享池借用服务器，cleanup 时归还而不是关闭
+        self.server_pool = server_pool
         self.log_messages_path = log_messages_path
+        # 后台日志写入：每条消息增量追加，工具定义每个会话只写一次
+        self.log_writer = None
+        if log_messages_path:
+            self.log_writer = ConversationLogWriter(
+                log_messages_path,
+                max_bytes=log_max_bytes,
+                compress=log_compress
+            )
+        self.parallel_tool_calls = parallel_tool_calls
 
         # 加载 MCP服务器配置文件
         mcp_server_config = load_config_from_file(mcp_server_config_path)
         servers_cfg = mcp_server_config.get('mcpServers', {})
 
-        # 启动 MCP服务器
+        # 工具清单缓存：lazy_start 时有缓存的服务器先用缓存的工具，第一次调用工具时才启动
+        # （可在配置中用 "lazy": false 关闭）；manifest_cache_path=False 时不使用缓存
+        self.manifest_cache = None
+        if manifest_cache_path is not False:
+            self.manifest_cache = ToolManifestCache(root=manifest_cache_path)
+        self._background = set()
+
+        # 内置 blob store 占用的服务器名不能再用于配置的服务器，否则其工具会被覆盖
+        reserved = BlobStore.server_name if blob_threshold else None
+
+        async def reject(server_name):
+            error = f'server name "{server_name}" is reserved for the built-in blob store'
+            logger.error(f"Server {server_name}: Not started, {error}")
+            return None, {"ok": False, "elapsed": 0.0, "tools": [], "error": error}
+
+        # 并发启动 MCP服务器，每个服务器有独立的启动时限（可在配置中用 startupTimeout 覆盖）
+        started = await asyncio.gather(*[
+            reject(name) if name == reserved
+            else self._open_server(name, conf, startup_timeout, lazy_start, manifest_revalidate_after)
+            for name, conf in servers_cfg.items()
+        ])
+
+        # 按配置顺序整理可用工具，保证 all_functions 的顺序稳定
         self.servers = {}
         self.all_functions = []
-        for server_name, conf in servers_cfg.items():
-            if "url" in conf:  # SSE server
-                client = SSEMCP(server_name, conf["url"])
-            else:  # Local process-based server
-                client = StdioMCP(
-                    server_name=server_name,
-                    command=conf.get("command"),
-                    args=conf.get("args", []),
-                    env=conf.get("env", {}),
-                    cwd=conf.get("cwd", None)
-                )
-
-            ok = await client.start()
-            if not ok:
-                print(f"[WARN] Could not start server {server_name}")
+        self.startup_report = {}
+        for server_name, (client, report) in zip(servers_cfg, started):
+            self.startup_report[server_name] = {
+                "ok": report["ok"],
+                "elapsed": report["elapsed"],
+                "tools": len(report["tools"]),
+                "error": report["error"],
+                "lazy": report.get("lazy", False)
+            }
+            if not report["ok"]:
+                if verbose:
+                    print(f"[WARN] Could not start server {server_name} ({report['error']}, {report['elapsed']:.2f}s)")
                 continue
-            else:
-                print(f"[OK] {server_name}")
-            
-            # 整理可用工具
-            tools = await client.list_tools()
-            for t in tools:
-                input_schema = t.get("inputSchema") or {"type": "object", "properties": {}}
-                fn_def = {
-                    "name": f"{server_name}_{t['name']}",
-                    "description": t.get("description", ""),
-                    "parameters": input_schema
-                }
-                self.all_functions.append(fn_def)
-
+            if verbose:
+                source = "cached manifest" if report.get("lazy") else f"{report['elapsed']:.2f}s"
+                print(f"[OK] {server_name} ({len(report['tools'])} tools, {source})")
+            self.all_functions.extend(tools_to_functions(server_name, report["tools"]))
             self.servers[server_name] = client
-        
-        if not self.servers:
+
+        # 只有内置 blob store 时也算没有可用的服务器
+        servers_started = bool(self.servers)
+
+        # 内置的 blob store 服务器，保存超过 blob_threshold 的工具结果；blob_threshold=None 时关闭。
+        # 超过 blob_max_age 秒或总大小超过 blob_max_bytes 时在写入时清理旧的 blob
+        self.blob_store = None
+        if blob_threshold:
+            self.blob_store = BlobStore(root=blob_store_path, threshold=blob_threshold,
+                                        max_bytes=blob_max_bytes, max_age=blob_max_age)
+            self.servers[BlobStore.server_name] = self.blob_store
+            self.all_functions.extend(tools_to_functions(BlobStore.server_name, self.blob_store.tools))
+
+        # 每个服务器的工具调用并发上限；配置 "sequential": true 的服务器一次只执行一个调用
+        self.max_tool_concurrency = max_tool_concurrency
+        self._servers_cfg = dict(servers_cfg)
+        # 工具结果缓存，只对配置了 cacheTools 的工具生效；可传入共享实例以跨会话复用
+        self.tool_cache = tool_cache if tool_cache is not None else ToolResultCache()
+        for server_name, client in self.servers.items():
+            self._register_server(server_name, client, servers_cfg.get(server_name, {}))
+
+        # 工具较多（超过 tool_subset_threshold）时每轮只发送与问题最相关的 tool_top_k 个工具，
+        # 加上对话中已经用过的工具；tool_top_k=None 时总是发送全部工具
+        self.tool_top_k = tool_top_k
+        self.tool_subset_threshold = tool_subset_threshold
+        self._used_tools = set()
+        self._full_tools_next = False
+        self._subset_names = set() # 上次发送的子集，之后只增不减，保持工具列表稳定
+
+        # 每次 LLM 请求的 token 用量和上下文缓存命中情况（最近 usage_history 条），以及累计值
+        self.usage = collections.deque(maxlen=usage_history)
+        self.usage_totals = self._empty_usage()
+        self.last_usage = self._empty_usage() # 最近一次 prompt 的累计用量
+
+        # 工具列表只在工具集合变化时重新构建
+        self._stale_servers = set()
+        self.tools_payload = ToolsPayload(self.all_functions)
+        self._build_tool_index()
+        if self.log_writer:
+            self.log_writer.log_functions(self.all_functions, self.tools_payload.fingerprint)
+
+        if not servers_started:
             error_msg = "No MCP servers could be started."
             return error_msg
         
         self.conversation = []
+        # 发送给模型前按 token 预算压缩上下文；context_token_budget=None 时不压缩
+        self.context_manager = None
+        if context_token_budget:
+            self.context_manager = ContextManager(
+                token_budget=context_token_budget,
+                summarizer=self.llm.summarize if summarize_history else None
+            )
 
         # 建立对话
         system_msg = "You are a helpful assistant."
-        self.conversation.append({"role": "system", "content": system_msg})
+        self._append({"role": "system", "content": system_msg})
+
+    async def _open_server(self, server_name, conf, startup_timeout, lazy_start, revalidate_after):
+        """
+        Start one server, or with lazy_start and a cached manifest return a
+        LazyServer advertising the cached tools. Returns (client, report).
+        """
+        entry = None
+        if lazy_start and conf.get("lazy", True) and self.manifest_cache is not None:
+            entry = self.manifest_cache.get(config_key(server_name, conf))
+        if entry is None:
+            return await self._start_server(server_name, conf, startup_timeout)
+
+        async def start():
+            return await self._start_server(server_name, conf, startup_timeout)
+        client = LazyServer(server_name, entry["tools"], start, self._release_server)
+        if time.time() - entry.get("updated_at", 0) >= revalidate_after:
+            self._spawn(self._revalidate(server_name, conf, client, startup_timeout))
+        return client, {"ok": True, "elapsed": 0.0, "tools": entry["tools"], "error": None, "lazy": True}
+
+    async def _start_server(self, server_name, conf, startup_timeout):
+        """Start (or borrow from the pool) one server. Returns (client, report)."""
+        timeout = conf.get("startupTimeout", startup_timeout)
+        if self.server_pool is not None:
+            client, report = await self.server_pool.acquire(server_name, conf, timeout)
+        else:
+            client = create_client(server_name, conf)
+            report = await start_server(server_name, client, timeout)
+            client = client if report["ok"] else None
+        if client is not None:
+            self._save_manifest(server_name, conf, client.tools)
+        return client, report
+
+    def _save_manifest(self, server_name, conf, tools):
+        if self.manifest_cache is not None and tools:
+            self.manifest_cache.put(config_key(server_name, conf), server_name, tools)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _revalidate(self, server_name, conf, lazy: LazyServer, startup_timeout):
+        """Refresh a cached manifest in the background by starting the server once."""
+        client, report = await self._start_server(server_name, conf, startup_timeout)
+        if client is None:
+            logger.warning(f"Server {server_name}: Could not revalidate cached tools ({report['error']})")
+            return
+        try:
+            if not lazy.started and client.tools:
+                lazy._set_tools(client.tools)
+        finally:
+            # 使用服务器池时，归还后服务器保持预热，第一次工具调用可直接复用
+            await self._release_server(client)
+
+    async def _release_server(self, client):
+        if self._on_tools_changed in client.tools_changed_callbacks:
+            client.tools_changed_callbacks.remove(self._on_tools_changed)
+        if self.server_pool is not None and self.server_pool.owns(client):
+            self.server_pool.release(client)
+        else:
+            await client.stop()
+
+    def _register_server(self, server_name, client, conf):
+        # 并发限制挂在真实客户端上，池中共享同一服务器的 agent 共用一个上限；
+        # 延迟启动的服务器在启动后才创建（或复用）真实客户端上的信号量
+        limit = max(1, 1 if conf.get("sequential") else conf.get("maxConcurrency", self.max_tool_concurrency))
+        if isinstance(client, LazyServer):
+            client.call_limit = limit
+        elif client.call_semaphore is None:
+            client.call_semaphore = asyncio.Semaphore(limit)
+        self.tool_cache.configure(server_name, conf.get("cacheTools"), conf.get("cacheTtl", 300))
+        client.tools_changed_callbacks.append(self._on_tools_changed)
+
+    def _on_tools_changed(self, server_name):
+        self._stale_servers.add(server_name)
+        self.tool_cache.invalidate(server_name)
+
+    def _rebuild_tools(self):
+        functions = []
+        for server_name, client in self.servers.items():
+            functions.extend(tools_to_functions(server_name, client.tools))
+        payload = ToolsPayload(functions)
+        if payload.fingerprint != self.tools_payload.fingerprint:
+            self.all_functions = functions
+            self.tools_payload = payload
+            self._build_tool_index()
+            if self.log_writer:
+                self.log_writer.log_functions(functions, payload.fingerprint)
+
+    async def _refresh_tools(self):
+        """Re-list tools of servers that reported tools/list_changed since the last turn."""
+        if not self._stale_servers:
+            return
+        stale, self._stale_servers = self._stale_servers, set()
+        stale = [name for name in stale if name in self.servers]
+        await asyncio.gather(*[self.servers[name].list_tools() for name in stale])
+        for name in stale:
+            if name in self._servers_cfg:
+                self._save_manifest(name, self._servers_cfg[name], self.servers[name].tools)
+        self._rebuild_tools()
+
+    async def add_server(self, server_name, conf, startup_timeout = 30):
+        """Start a new server and add its tools. Returns its startup report entry."""
+        if server_name in self.servers:
+            await self.remove_server(server_name)
+        client, report = await self._start_server(server_name, conf, startup_timeout)
+        if report["ok"]:
+            self._servers_cfg[server_name] = conf
+            self.servers[server_name] = client
+            self._register_server(server_name, client, conf)
+            self._rebuild_tools()
+        return report
+
+    async def remove_server(self, server_name):
+        """Stop a server and drop its tools."""
+        client = self.servers.pop(server_name, None)
+        if client is None:
+            return
+        self._servers_cfg.pop(server_name, None)
+        self._stale_servers.discard(server_name)
+        self.tool_cache.configure(server_name, None)
+        self.tool_cache.invalidate(server_name)
+        await self._release_server(client)
+        self._rebuild_tools()
+
+    def _build_tool_index(self):
+        self._subset_payloads = {}
+        self.tool_index = None
+        if self.tool_top_k and len(self.all_functions) > self.tool_subset_threshold:
+            self.tool_index = ToolIndex(self.all_functions)
+
+    def _select_tools(self) -> ToolsPayload:
+        """
+        Tools sent with this turn's request: the top-k matches for the recent
+        user messages plus every tool used so far. Falls back to the full
+        catalog when nothing matches or the model asked for a tool it was not
+        shown. New matches are added to the previous subset rather than
+        replacing it (until it holds more than 2 * top-k unused tools), so
+        the tools in the cached request prefix change as rarely as possible.
+        """
+        if self.tool_index is None or self._full_tools_next:
+            self._full_tools_next = False
+            return self.tools_payload
+        queries = [m["content"] for m in reversed(self.conversation)
+                   if m.get("role") == "user" and isinstance(m.get("content"), str)][:2]
+        names = set(self.tool_index.search(" ".join(queries), self.tool_top_k))
+        if not names:
+            return self.tools_payload
+        # 在上次的子集上追加新匹配的工具，工具列表（请求前缀）尽量不变；过大时重新选择
+        merged = self._subset_names | names
+        if len(merged - self._used_tools) <= 2 * self.tool_top_k:
+            names = merged
+        self._subset_names = names
+        pinned = BlobStore.server_name + "_"
+        functions = [f for f in self.all_functions
+                     if f["name"] in names or f["name"] in self._used_tools or f["name"].startswith(pinned)]
+        key = tuple(f["name"] for f in functions)
+        payload = self._subset_payloads.get(key)
+        if payload is None:
+            # 相同的子集复用同一个 payload（序列化结果和指纹）
+            if len(self._subset_payloads) >= 64:
+                self._subset_payloads.clear()
+            payload = self._subset_payloads[key] = ToolsPayload(functions)
+        return payload
+
+    @staticmethod
+    def _empty_usage():
+        return {"requests": 0, **{field: 0 for field in _USAGE_FIELDS}}
+
+    def _record_usage(self, result, payload: ToolsPayload, mode: str, elapsed: float):
+        """Record the token usage and context cache hits of one LLM response."""
+        usage = result.get("usage")
+        record = {"mode": mode, "elapsed": elapsed, "ttft": result.get("ttft"),
+                  "tools": len(payload), "tools_fingerprint": payload.fingerprint[:12]}
+        for totals in (self.usage_totals, self.last_usage):
+            totals["requests"] += 1
+        if usage:
+            record.update(usage)
+            for totals in (self.usage_totals, self.last_usage):
+                for field in _USAGE_FIELDS:
+                    totals[field] += usage.get(field) or 0
+            if usage["prompt_tokens"]:
+                logger.info(f"LLM usage: {usage['prompt_tokens']} prompt tokens "
+                            f"({usage['cache_hit_tokens'] / usage['prompt_tokens']:.0%} cache hit), "
+                            f"{usage['completion_tokens']} completion tokens")
+        self.usage.append(record)
+
+    def usage_summary(self):
+        """Token usage and context cache hit ratio accumulated over this agent's requests."""
+        totals = dict(self.usage_totals)
+        prompt_tokens = totals["prompt_tokens"]
+        totals["cache_hit_ratio"] = totals["cache_hit_tokens"] / prompt_tokens if prompt_tokens else 0.0
+        ttfts = [r["ttft"] for r in self.usage if r.get("ttft") is not None]
+        totals["ttft_avg"] = sum(ttfts) / len(ttfts) if ttfts else None
+        return totals
+
+    def _note_tool_calls(self, tool_calls, payload: ToolsPayload):
+        """Remember used tools; request the full catalog next turn if the model went outside the subset."""
+        offered = {f["name"] for f in payload.functions}
+        for tc in tool_calls:
+            name = tc.get("function", {}).get("name")
+            if not name:
+                continue
+            self._used_tools.add(name)
+            if name not in offered:
+                self._full_tools_next = True
+
+    def _append(self, message):
+        """Append a message to the conversation and queue it for the log."""
+        self.conversation.append(message)
+        if self.log_writer:
+            self.log_writer.log_message(message)
+
+    def _rollback(self, mark):
+        """
+        Drop the messages of an unfinished prompt, so the history does not
+        end with an unanswered user message or tool_calls the provider would
+        reject on the next request.
+        """
+        if len(self.conversation) > mark:
+            logger.warning(f"Prompt did not complete, dropping its {len(self.conversation) - mark} message(s) from the conversation")
+            del self.conversation[mark:]
 
     async def cleanup(self):
-        """Clean up servers and log messages"""
-        if self.log_messages_path:
-            await log_messages_to_file(self.conversation, self.all_functions, self.log_messages_path)
-        for cli in self.servers.values():
-            await cli.stop()
+        """Clean up servers and flush the message log"""
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+        if self.log_writer:
+            await self.log_writer.close()
+        await asyncio.gather(*[self._release_server(cli) for cli in self.servers.values()])
         self.servers.clear()
 
-    async def prompt(self, user_query):
-        self.conversation.append({"role": "user", "content": user_query})
-        if self.stream:
+    async def _prepare_messages(self, payload: ToolsPayload):
+        """Messages sent to the model this turn, compacted to the token budget."""
+        if self.context_manager is None:
+            return self.conversation
+        return await self.context_manager.compact(
+            self.conversation,
+            reserved_tokens=estimate_tokens(payload.serialized)
+        )
+
+    async def _run_tool_call(self, tc):
+        srv_name = tc["function"]["name"].split("_", 1)[0]
+        semaphore = getattr(self.servers.get(srv_name), "call_semaphore", None)
+        if semaphore is None:
+            return await process_tool_call(tc, self.servers, self.tool_cache, self.blob_store, self.verbose)
+        async with semaphore:
+            return await process_tool_call(tc, self.servers, self.tool_cache, self.blob_store, self.verbose)
+
+    async def _run_tool_calls(self, tool_calls, started = None):
+        """
+        Run the tool calls of one assistant turn.
+
+        Calls are executed concurrently (bounded per server) unless
+        parallel_tool_calls is disabled; results are returned in the same
+        order as tool_calls so they line up with their tool_call_id.
+        started maps tool_call_id to tasks already dispatched while the
+        response was streaming; their results are reused.
+        """
+        started = started if started is not None else {}
+
+        def run(tc):
+            task = started.pop(tc.get("id"), None)
+            return task if task is not None else self._run_tool_call(tc)
+
+        if not self.parallel_tool_calls or len(tool_calls) < 2:
+            return [await run(tc) for tc in tool_calls]
+        return await asyncio.gather(*[run(tc) for tc in tool_calls])
+
+    async def prompt(self, user_query, stream = None):
+        """
+        Run one user query through the tool loop.
+
+        Returns the final text, or an async generator of text chunks when
+        streaming (stream overrides the agent's default for this call).
+        If the prompt fails or the stream is closed early, the conversation
+        is rolled back to before the query so the session stays usable.
+        """
+        stream = self.stream if stream is None else stream
+        self.last_usage = self._empty_usage()
+        mark = len(self.conversation)
+        self._append({"role": "user", "content": user_query})
+        if stream:
             async def stream_response():
+                start = time.perf_counter()
+                iterations = 0
+                completed = False
                 try:
                     while True:  # Main conversation loop
-                        generator = await llm.get_deepseek_response(self.conversation, self.all_functions, stream=True)
-                        accumulated_text = ""
+                        iterations += 1
+                        await self._refresh_tools()
+                        payload = self._select_tools()
+                        TOOLS_PER_REQUEST.observe(len(payload))
+                        messages = await self._prepare_messages(payload)
+                        request_start = time.perf_counter()
+                        generator = await self.llm.get_deepseek_response(
+                            messages, payload, stream=True, flush_interval=self.stream_flush_interval
+                        )
+                        streamed_chars = 0
                         tool_calls_processed = False
+                        # 参数已经完整的工具调用在流结束前就开始执行：tool_call_id -> Task
+                        started = {}
                         
-                        async for chunk in generator:
-                            if chunk.get("is_chunk", False):
-                                # Immediately yield each token without accumulation
-                                if chunk.get("token", False):
-                                    yield chunk["assistant_text"]
-                                accumulated_text += chunk["assistant_text"]
-                            else:
-                                # This is the final chunk with tool calls
-                                if accumulated_text != chunk["assistant_text"]:
+                        try:
+                            async for chunk in generator:
+                                if chunk.get("is_chunk", False):
+                                    # Yield text as soon as the LLM client flushes it
+                                    if chunk.get("token", False):
+                                        yield chunk["assistant_text"]
+                                    streamed_chars += len(chunk["assistant_text"])
+                                    if "tool_call_done" in chunk and self.parallel_tool_calls:
+                                        for tc in chunk["tool_calls"]:
+                                            tc["type"] = "function"
+                                            started[tc["id"]] = asyncio.create_task(self._run_tool_call(tc))
+                                            TOOL_CALLS_EARLY_TOTAL.inc()
+                                else:
+                                    self._record_usage(chunk, payload, "stream", time.perf_counter() - request_start)
+                                    # This is the final chunk with tool calls
                                     # If there's any remaining text, yield it
-                                    remaining = chunk["assistant_text"][len(accumulated_text):]
+                                    remaining = chunk["assistant_text"][streamed_chars:]
                                     if remaining:
                                         yield remaining
                                 
-                                # Process any tool calls from the final chunk
-                                tool_calls = chunk.get("tool_calls", [])
-                                if tool_calls:
-                                    # Add type field to each tool call
-                                    for tc in tool_calls:
-                                        tc["type"] = "function"
-                                    # Add the assistant's message with tool calls
-                                    assistant_message = {
-                                        "role": "assistant",
-                                        "content": chunk["assistant_text"],
-                                        "tool_calls": tool_calls
-                                    }
-                                    self.conversation.append(assistant_message)
+                                    # Process any tool calls from the final chunk
+                                    tool_calls = chunk.get("tool_calls", [])
+                                    if tool_calls:
+                                        # Add type field to each tool call
+                                        for tc in tool_calls:
+                                            tc["type"] = "function"
+                                        self._note_tool_calls(tool_calls, payload)
+                                        # Add the assistant's message with tool calls
+                                        assistant_message = {
+                                            "role": "assistant",
+                                            "content": chunk["assistant_text"],
+                                            "tool_calls": tool_calls
+                                        }
+                                        self._append(assistant_message)
                                     
-                                    # Process each tool call
-                                    for tc in tool_calls:
-                                        if tc.get("function", {}).get("name"):
-                                            result = await process_tool_call(tc, self.servers)
+                                        # Process the tool calls of this turn
+                                        results = await self._run_tool_calls(
+                                            [tc for tc in tool_calls if tc.get("function", {}).get("name")],
+                                            started
+                                        )
+                                        for result in results:
                                             if result:
-                                                self.conversation.append(result)
+                                                self._append(result)
                                                 tool_calls_processed = True
+                                    elif chunk["assistant_text"]:
+                                        # 最终回答也记入对话，保证连续对话的上下文完整
+                                        self._append({"role": "assistant", "content": chunk["assistant_text"]})
+                        finally:
+                            # 流中断或出错时取消还没有被收集结果的提前执行
+                            for task in started.values():
+                                task.cancel()
                         
                         # Break the loop if no tool calls were processed
                         if not tool_calls_processed:
                             break
+                    completed = True
                         
                 finally:
-                    pass
+                    if not completed:
+                        self._rollback(mark)
+                    PROMPT_SECONDS.observe(time.perf_counter() - start, mode="stream")
+                    PROMPT_ITERATIONS.observe(iterations, mode="stream")
             return stream_response()
         else:
+            start = time.perf_counter()
+            iterations = 0
+            completed = False
             try:
                 final_text = ""
                 while True:
-                    gen_result = await llm.get_deepseek_response(self.conversation, all_functions=self.all_functions)
+                    iterations += 1
+                    await self._refresh_tools()
+                    payload = self._select_tools()
+                    TOOLS_PER_REQUEST.observe(len(payload))
+                    messages = await self._prepare_messages(payload)
+                    request_start = time.perf_counter()
+                    gen_result = await self.llm.get_deepseek_response(messages, all_functions=payload)
+                    self._record_usage(gen_result, payload, "sync", time.perf_counter() - request_start)
                     assistant_text = gen_result['assistant_text']
                     final_text = assistant_text
                     tool_calls = gen_result.get('tool_calls', [])
 
-                    # 清除 reasoning_content
-                    clean_reasoning_content(self.conversation)
-
                     assistant_msg = {"role": "assistant", "content": assistant_text}
                     if tool_calls:
                         for tc in tool_calls:
                             tc["type"] = "function"
+                        self._note_tool_calls(tool_calls, payload)
                         assistant_msg["tool_calls"] = tool_calls
-                    self.conversation.append(assistant_msg)
-                    logger.info(f"Added assistant message: {json.dumps(assistant_msg, indent=2)}")
+                    self._append(assistant_msg)
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info(f"Added assistant message: {codec.dumps_pretty(assistant_msg)}")
 
                     if not tool_calls:
                         break
 
-                    for tc in tool_calls:
-                        result = await process_tool_call(tc, self.servers)
+                    for result in await self._run_tool_calls(tool_calls):
                         if result:
-                                self.conversation.append(result)
-                                logger.info(f"Added tool result: {json.dumps(result, indent=2)}")
+                                self._append(result)
+                                if logger.isEnabledFor(logging.INFO):
+                                    logger.info(f"Added tool result: {codec.dumps_pretty(result)}")
+                completed = True
                 
             finally:
-                return final_text
+                if not completed:
+                    self._rollback(mark)
+                PROMPT_SECONDS.observe(time.perf_counter() - start, mode="sync")
+                PROMPT_ITERATIONS.observe(iterations, mode="sync")
+            return final_text
 
-async def run_interaction(user_query, mcp_config_path, log_messages_path, stream=False):
+async def run_interaction(user_query, mcp_config_path, log_messages_path, stream=False,
+                          server_pool: ServerPool = None, **options):
+    """
+    Answer a single query with a fresh agent.
+
+    Pass server_pool (e.g. process_mcp.pool.get_server_pool()) to reuse warm
+    MCP servers across calls instead of spawning them every time; other
+    options are passed to MCPAgent.create.
+    """
     agent = await MCPAgent.create(
         mcp_server_config_path=mcp_config_path,
         log_messages_path=log_messages_path,
-        stream=stream
+        stream=stream,
+        server_pool=server_pool,
+        **options
     )
-    response = await agent.prompt(user_query=user_query)
-    await agent.cleanup()
-    return response
+    try:
+        return await agent.prompt(user_query=user_query)
+    finally:
+        await agent.cleanup()
 
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+import logging
+
+import codec
+
+logger = logging.getLogger("my_mcp")
+
+
+class BlobStore:
+    """
+    Content-addressed local store for oversized tool results.
+
+    Results larger than threshold are written once under root (sha256 of the
+    content) and only a preview plus a reference goes into the conversation.
+    The store also behaves like a built-in MCP server named "blobstore" with
+    a single "read" tool, so the model can page through the full content.
+
+    The store is bounded: on write, blobs older than max_age seconds are
+    deleted, and when the store grows beyond max_bytes the least recently
+    written blobs are deleted until it is under 90% of that. The directory
+    is rescanned every prune_interval seconds (other processes may share
+    it). A pruned blob reads as "not found".
+    """
+    server_name = "blobstore"
+
+    def __init__(self, root: str = None, threshold: int = 64 * 1024,
+                 preview_chars: int = 2000, page_chars: int = 8000,
+                 max_bytes: int = 1024 ** 3, max_age: float = 7 * 24 * 3600, prune_interval: float = 600):
+        self.root = os.path.expanduser(root or "~/.cache/my_mcp/blobs")
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self._bytes = None # 目录中 blob 的总大小，上次扫描后按写入累加；None 表示还没有扫描过
+        self._last_prune = 0.0
+        self._prune_lock = threading.Lock() # _write 在线程池中执行
+        self.preview_chars = preview_chars
+        self.page_chars = page_chars
+        self.tools_changed_callbacks = []
+        self.call_semaphore = None
+        self.tools = [
+            {
+                "name": "read",
+                "description": "Read a page of a large tool result that was stored as a blob. "
+                               "Use the blob id from the truncated result and increase offset to continue.",
+                "inputSchema": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string", "description": "Blob id"},
+                        "offset": {"type": "integer", "description": "Character offset to start from", "default": 0},
+                        "length": {"type": "integer", "description": f"Number of characters to read (max {page_chars})"}
+                    },
+                    "required": ["id"]
+                }
+            }
+        ]
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def _write(self, digest: str, data: bytes):
+        path = self._path(digest)
+        if os.path.exists(path):
+            # 重复写入时刷新修改时间，清理时按最近写入保留
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._prune_lock:
+            if self._bytes is not None:
+                self._bytes += len(data)
+            if (self._bytes is None or time.monotonic() - self._last_prune >= self.prune_interval
+                    or (self.max_bytes and self._bytes > self.max_bytes)):
+                self._prune(keep=path)
+
+    def _prune(self, keep: str = None):
+        """Delete expired blobs, then the oldest ones while over max_bytes. Called with _prune_lock held."""
+        now = time.time()
+        blobs = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.endswith(".tmp") or path == keep:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((st.st_mtime, st.st_size, path))
+        blobs.sort()
+        total = sum(size for _, size, _ in blobs) + (os.path.getsize(keep) if keep else 0)
+        removed = 0
+        target = self.max_bytes * 0.9 if self.max_bytes else None
+        for mtime, size, path in blobs:
+            expired = self.max_age and now - mtime > self.max_age
+            if not expired and (target is None or total <= target):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Blob store: Removed {removed} old blobs, {total / 2 ** 20:.1f} MiB left")
+        self._bytes = total
+        self._last_prune = time.monotonic()
+
+    def _read(self, digest: str) -> str:
+        with open(self._path(digest), "rb") as f:
+            return f.read().decode("utf-8")
+
+    async def put(self, content: str) -> str:
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, digest, data)
+        return digest
+
+    async def spill(self, content: str) -> str:
+        """
+        Return content unchanged if it is small, otherwise store it and return
+        a JSON preview referencing the blob.
+        """
+        if self.threshold is None or len(content) <= self.threshold:
+            return content
+        try:
+            digest = await self.put(content)
+        except Exception as e:
+            logger.error(f"Could not store tool result in blob store: {str(e)}")
+            return content
+        return codec.dumps({
+            "preview": content[:self.preview_chars],
+            "blob": {"id": digest, "size": len(content)},
+            "note": f"Result truncated ({len(content)} characters). "
+                    f"Call {self.server_name}_read with this id and an offset to read the rest."
+        })
+
+    # ---- built-in server interface ---- #
+    async def start(self):
+        return True
+
+    async def list_tools(self):
+        return self.tools
+
+    async def call_tool(self, tool_name: str, arguments: dict):
+        if tool_name != "read":
+            return {"error": f"Unknown tool: {tool_name}"}
+        digest = str(arguments.get("id", ""))
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            return {"error": f"Invalid blob id: {digest}"}
+        try:
+            offset = max(0, int(arguments.get("offset", 0)))
+            length = min(self.page_chars, max(1, int(arguments.get("length", self.page_chars))))
+        except (TypeError, ValueError):
+            return {"error": "offset and length must be integers"}
+        try:
+            content = await asyncio.to_thread(self._read, digest)
+        except FileNotFoundError:
+            return {"error": f"Blob not found: {digest}"}
+        page = content[offset:offset + length]
+        next_offset = offset + len(page)
+        return {
+            "content": [{"type": "text", "text": page}],
+            "offset": offset,
+            "next_offset": next_offset if next_offset < len(content) else None,
+            "total": len(content)
+        }
+
+    async def stop(self):
+        pass
@@ -0,0 +1,83 @@
+import time
+
+import logging
+
+from metrics import CIRCUIT_OPEN_TOTAL
+
+logger = logging.getLogger("my_mcp")
+
+
+class CircuitBreaker:
+    """
+    Fail-fast guard for tool calls to one server.
+
+    After failure_threshold consecutive timed-out calls the breaker opens
+    and calls are rejected immediately instead of queuing more work on a
+    stalled server. After reset_timeout seconds one probe call is let
+    through (half-open): success closes the breaker, another timeout opens
+    it again. Any call that completes in time resets the count.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, server_name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.server_name = server_name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0 # 连续超时次数
+        self._opened_at = 0.0
+        self._probing = False # 半开状态下是否已有探测调用在进行
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.failure_threshold) and self.failure_threshold > 0
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a probe call through."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may be sent now; a True in half-open state makes it the probe."""
+        if not self.enabled or self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if self.retry_in() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Server {self.server_name}: Circuit closed, server is answering again")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_timeout(self):
+        self.failures += 1
+        self._probing = False
+        if not self.enabled:
+            return
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                CIRCUIT_OPEN_TOTAL.inc(server=self.server_name)
+                logger.warning(f"Server {self.server_name}: Circuit opened after {self.failures} timed out calls, "
+                               f"failing fast for {self.reset_timeout}s")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def release(self):
+        """A call let through by allow() ended without a verdict (cancelled, connection error)."""
+        self._probing = False
+
+    def rejection(self) -> dict:
+        return {"error": f"Server {self.server_name} is not responding "
+                         f"({self.failures} consecutive timeouts), retry in {self.retry_in():.1f}s"}
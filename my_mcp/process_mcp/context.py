@@ -0,0 +1,151 @@
+from typing import List, Dict, Callable, Awaitable, Optional
+
+import logging
+
+logger = logging.getLogger("my_mcp")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap, conservative token estimate.
+
+    UTF-8 bytes / 3 slightly over-counts English (~4 chars per token) and
+    roughly matches CJK text (3 bytes and about one token per character).
+    """
+    if not text:
+        return 0
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def estimate_message_tokens(message: Dict) -> int:
+    tokens = 4 # role and framing overhead
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_tokens(content)
+    for tc in message.get("tool_calls") or []:
+        function = tc.get("function", {})
+        tokens += estimate_tokens(function.get("name", "")) + estimate_tokens(function.get("arguments", ""))
+    return tokens
+
+
+def split_turns(conversation: List[Dict]):
+    """
+    Split a conversation into leading system messages and turns.
+
+    A turn starts at a user message and holds everything up to the next one,
+    so an assistant message with tool_calls always stays in the same turn as
+    its tool results.
+    """
+    head = []
+    i = 0
+    while i < len(conversation) and conversation[i].get("role") == "system":
+        head.append(conversation[i])
+        i += 1
+    turns = []
+    for message in conversation[i:]:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return head, turns
+
+
+def truncate_tool_message(message: Dict, max_chars: int) -> Dict:
+    content = message.get("content")
+    if message.get("role") != "tool" or not isinstance(content, str) or len(content) <= max_chars:
+        return message
+    elided = len(content) - max_chars
+    truncated = dict(message)
+    truncated["content"] = content[:max_chars] + f"\n...[{elided} characters of earlier tool output elided]"
+    return truncated
+
+
+class ContextManager:
+    """
+    Keeps the messages sent to the model within a token budget.
+
+    The full history stays in MCPAgent.conversation; compact() returns the
+    list that is actually sent. Steps, applied until the request fits:
+      1. tool outputs older than the last keep_recent_turns turns are cut to max_tool_chars
+      2. the oldest turns are dropped (optionally replaced by a summary)
+      3. tool outputs in the remaining turns are cut as well
+    System messages and the current turn are always kept.
+
+    Dropping is sticky so the request prefix (and the provider's context
+    cache) survives several turns: once turns have to go, enough are
+    dropped to fit low_water of the budget, and later turns keep that
+    cut-off until the budget is exceeded again.
+    """
+    def __init__(self,
+                 token_budget: int = 48000,
+                 max_tool_chars: int = 4000,
+                 keep_recent_turns: int = 2,
+                 summarizer: Optional[Callable[[List[Dict]], Awaitable[str]]] = None,
+                 low_water: float = 0.75):
+        self.token_budget = token_budget
+        self.max_tool_chars = max_tool_chars
+        self.keep_recent_turns = keep_recent_turns
+        self.summarizer = summarizer
+        self.low_water = low_water
+        # 上次丢弃的轮数，之后的轮次沿用，保持前缀不变
+        self._dropped = 0
+        # 已摘要的轮数和摘要内容，避免每轮重复摘要
+        self._summarized_turns = 0
+        self._summary = None
+
+    @staticmethod
+    def _turns_tokens(turns) -> int:
+        return sum(estimate_message_tokens(m) for turn in turns for m in turn)
+
+    async def _summarize(self, dropped_turns: List[List[Dict]]) -> Optional[str]:
+        if not self.summarizer:
+            return None
+        if len(dropped_turns) == self._summarized_turns:
+            return self._summary
+        new_turns = dropped_turns[self._summarized_turns:]
+        messages = [m for turn in new_turns for m in turn]
+        if self._summary:
+            messages = [{"role": "system", "content": f"Summary so far: {self._summary}"}] + messages
+        try:
+            self._summary = await self.summarizer(messages)
+            self._summarized_turns = len(dropped_turns)
+        except Exception as e:
+            logger.error(f"Context summarization failed: {str(e)}")
+        return self._summary
+
+    async def compact(self, conversation: List[Dict], reserved_tokens: int = 0) -> List[Dict]:
+        """Return the messages to send for this turn, fitting token_budget - reserved_tokens."""
+        budget = self.token_budget - reserved_tokens
+        head, turns = split_turns(conversation)
+        head_tokens = sum(estimate_message_tokens(m) for m in head)
+        if head_tokens + self._turns_tokens(turns) <= budget:
+            self._dropped = 0
+            return list(conversation)
+
+        # 1. 截断较早轮次中的工具输出
+        recent = max(1, self.keep_recent_turns)
+        turns = [
+            [truncate_tool_message(m, self.max_tool_chars) for m in turn] if i < len(turns) - recent else turn
+            for i, turn in enumerate(turns)
+        ]
+
+        # 2. 丢弃最早的轮次（当前轮次始终保留），一次丢到 low_water 以下
+        dropped = min(self._dropped, len(turns) - 1)
+        if head_tokens + self._turns_tokens(turns[dropped:]) > budget:
+            target = budget * self.low_water
+            while len(turns) - dropped > 1 and head_tokens + self._turns_tokens(turns[dropped:]) > target:
+                dropped += 1
+        self._dropped = dropped
+        kept = turns[dropped:]
+
+        summary_messages = []
+        if dropped:
+            summary = await self._summarize(turns[:dropped])
+            if summary:
+                summary_messages = [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}]
+            logger.info(f"Context compaction dropped {dropped} earlier turns")
+
+        # 3. 仍然超出预算时，截断剩余轮次中的工具输出
+        if head_tokens + self._turns_tokens(kept) > budget:
+            kept = [[truncate_tool_message(m, self.max_tool_chars) for m in turn] for turn in kept]
+
+        return head + summary_messages + [m for turn in kept for m in turn]
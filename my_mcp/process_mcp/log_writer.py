@@ -0,0 +1,134 @@
+import asyncio
+import gzip
+import os
+import shutil
+import time
+import uuid
+
+from typing import Dict, List
+
+import logging
+
+import codec
+
+logger = logging.getLogger("my_mcp")
+
+
+class ConversationLogWriter:
+    """
+    Background JSONL writer for conversation logs.
+
+    log() only copies the record and puts it on a queue; a background task
+    batches records and serializes/writes them in a worker thread, so the
+    event loop never blocks on disk. Each line is one event:
+
+        {"type": "functions", "session": ..., "time": ..., "functions": [...]}
+        {"type": "message", "session": ..., "time": ..., "message": {...}}
+
+    Tool definitions are written once per session (and again only if they
+    change). The file is rotated to log_path.1, .2, ... once it exceeds
+    max_bytes, optionally gzip-compressed.
+    """
+    def __init__(self, log_path: str, session_id: str = None,
+                 flush_interval: float = 1.0, batch_size: int = 256,
+                 max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                 compress: bool = False):
+        self.log_path = log_path
+        self.session_id = session_id or uuid.uuid4().hex
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._queue = None
+        self._task = None
+        self._functions_fingerprint = None
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    def log_message(self, message: Dict):
+        self._put({"type": "message", "message": dict(message)})
+
+    def log_functions(self, functions: List[Dict], fingerprint: str = None):
+        """Write the tool definitions, unless the same set was already written this session."""
+        if fingerprint is not None and fingerprint == self._functions_fingerprint:
+            return
+        self._functions_fingerprint = fingerprint
+        self._put({"type": "functions", "functions": list(functions)})
+
+    def _put(self, record: Dict):
+        if self._task is None:
+            self.start()
+        record["session"] = self.session_id
+        record["time"] = time.time()
+        self._queue.put_nowait(record)
+
+    async def _run(self):
+        while True:
+            record = await self._queue.get()
+            if record is None:
+                return
+            batch = [record]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"Error logging messages to {self.log_path}: {str(e)}")
+            if stop:
+                return
+
+    def _write_batch(self, batch: List[Dict]):
+        data = b"".join(codec.dumpb(record, ensure_ascii=False) + b"\n" for record in batch)
+        log_dir = os.path.dirname(self.log_path)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+            size = f.tell()
+        if self.max_bytes and size >= self.max_bytes:
+            self._rotate()
+
+    def _backup_name(self, index: int) -> str:
+        name = f"{self.log_path}.{index}"
+        return name + ".gz" if self.compress else name
+
+    def _rotate(self):
+        if self.backup_count <= 0:
+            os.remove(self.log_path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = self._backup_name(i)
+            if os.path.exists(src):
+                os.replace(src, self._backup_name(i + 1))
+        if self.compress:
+            with open(self.log_path, "rb") as src, gzip.open(self._backup_name(1), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, self._backup_name(1))
+
+    async def close(self):
+        """Flush everything queued so far and stop the background task."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        finally:
+            self._task = None
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import time
+
+from typing import Callable, Dict, List, Optional
+
+import logging
+
+logger = logging.getLogger("my_mcp")
+
+
+class ToolManifestCache:
+    """
+    On-disk cache of each server's tools/list result.
+
+    Entries are keyed by pool.config_key() of the server's config entry, so
+    changing the command, args, env or url of a server invalidates its
+    manifest automatically.
+    """
+    def __init__(self, root: str = None):
+        self.root = os.path.expanduser(root or "~/.cache/my_mcp/manifests")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return {"server", "tools", "updated_at"} or None if there is no usable entry."""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable tool manifest {key}: {str(e)}")
+            return None
+        if not isinstance(entry, dict) or not isinstance(entry.get("tools"), list):
+            return None
+        return entry
+
+    def put(self, key: str, server_name: str, tools: List[Dict]):
+        path = self._path(key)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"server": server_name, "tools": tools, "updated_at": time.time()}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Could not write tool manifest for {server_name}: {str(e)}")
+
+
+class LazyServer:
+    """
+    Stand-in client advertising a server's cached tools without starting it.
+
+    The real client is obtained through start() on the first tool call (all
+    concurrent first calls share one startup) and returned through release()
+    on stop(). Once started, tools/list_changed notifications of the real
+    client are forwarded and its tool list replaces the cached one.
+    Calls are bounded by the real client's call_semaphore (created from
+    call_limit if the client has none yet), so agents sharing a pooled
+    server share its limit.
+    """
+    def __init__(self, server_name: str, tools: List[Dict],
+                 start: Callable, release: Callable):
+        self.server_name = server_name
+        self.tools = tools
+        self.tools_changed_callbacks = []
+        self.call_semaphore = None # 并发限制在真实客户端上，见 call_limit
+        self.call_limit = None
+        self._start = start # async () -> (client, report)
+        self._release = release # async (client) -> None
+        self._client = None
+        self._starting = None
+        self.last_error = None
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None
+
+    def _forward_tools_changed(self, server_name):
+        for callback in list(self.tools_changed_callbacks):
+            callback(self.server_name)
+
+    def _set_tools(self, tools):
+        changed = tools != self.tools
+        self.tools = tools
+        if changed:
+            self._forward_tools_changed(self.server_name)
+
+    async def _ensure_started(self):
+        if self._client is not None:
+            return self._client
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._bring_up())
+        try:
+            return await asyncio.shield(self._starting)
+        finally:
+            if self._starting is not None and self._starting.done():
+                self._starting = None
+
+    async def _bring_up(self):
+        logger.info(f"Server {self.server_name}: Starting on first tool call")
+        client, report = await self._start()
+        if client is None:
+            self.last_error = report.get("error")
+            return None
+        self.last_error = None
+        self._client = client
+        if client.call_semaphore is None and self.call_limit:
+            client.call_semaphore = asyncio.Semaphore(self.call_limit)
+        client.tools_changed_callbacks.append(self._forward_tools_changed)
+        if client.tools:
+            self._set_tools(client.tools)
+        return client
+
+    # ---- client interface ---- #
+    async def start(self):
+        return await self._ensure_started() is not None
+
+    async def list_tools(self):
+        if self._client is None:
+            return self.tools
+        tools = await self._client.list_tools()
+        if tools:
+            self._set_tools(tools)
+        return self.tools
+
+    async def call_tool(self, tool_name: str, arguments: dict, timeout: float = None):
+        client = await self._ensure_started()
+        if client is None:
+            return {"error": f"Server {self.server_name} could not be started: {self.last_error}"}
+        if client.call_semaphore is None:
+            return await client.call_tool(tool_name, arguments, timeout=timeout)
+        async with client.call_semaphore:
+            return await client.call_tool(tool_name, arguments, timeout=timeout)
+
+    def is_alive(self) -> bool:
+        return self._client is None or self._client.is_alive()
+
+    async def ping(self, timeout: float = 5) -> bool:
+        return self._client is None or await self._client.ping(timeout)
+
+    async def stop(self):
+        if self._starting is not None:
+            self._starting.cancel()
+            self._starting = None
+        client, self._client = self._client, None
+        if client is not None:
+            if self._forward_tools_changed in client.tools_changed_callbacks:
+                client.tools_changed_callbacks.remove(self._forward_tools_changed)
+            await self._release(client)
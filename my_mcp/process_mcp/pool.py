@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import json
+import time
+
+from typing import Dict
+
+import logging
+
+from process_mcp.transport import StdioMCP
+from process_mcp.transport import SSEMCP
+from process_mcp.transport import StreamableHTTPMCP
+
+logger = logging.getLogger("my_mcp")
+
+# 远程服务器的可选配置项 -> 客户端参数
+_REMOTE_OPTIONS = {
+    "headers": "headers",
+    "timeout": "timeout",
+    "sseReadTimeout": "sse_read_timeout",
+    "maxConnections": "max_connections",
+    "maxKeepaliveConnections": "max_keepalive_connections",
+    "keepaliveExpiry": "keepalive_expiry",
+    "reconnectDelay": "reconnect_delay",
+    "maxReconnectDelay": "max_reconnect_delay",
+    "maxReconnectAttempts": "max_reconnect_attempts",
+    "reconnectWait": "reconnect_wait",
+    "pingInterval": "ping_interval",
+}
+
+# 工具调用截止时间和熔断的配置项（本地和远程服务器通用） -> 客户端参数
+_CALL_OPTIONS = {
+    "callTimeout": "call_timeout",
+    "toolTimeouts": "tool_timeouts",
+    "circuitBreakerThreshold": "breaker_threshold",
+    "circuitBreakerReset": "breaker_reset",
+}
+
+# 只影响 agent 行为、不影响服务器进程/连接本身的配置项，不参与池的键
+_AGENT_ONLY_KEYS = {"startupTimeout", "sequential", "maxConcurrency", "cacheTools", "cacheTtl", "lazy"}
+
+
+def create_client(server_name: str, conf: dict):
+    """Build the transport client for one entry of the mcpServers config."""
+    kwargs = {arg: conf[key] for key, arg in _CALL_OPTIONS.items() if key in conf}
+    if "url" in conf:  # remote server: SSE (default) or streamable HTTP
+        kwargs.update({arg: conf[key] for key, arg in _REMOTE_OPTIONS.items() if key in conf})
+        transport = str(conf.get("transport") or conf.get("type") or "sse").lower().replace("-", "_")
+        if transport in ("streamable_http", "streamablehttp", "http"):
+            return StreamableHTTPMCP(server_name, conf["url"], **kwargs)
+        return SSEMCP(server_name, conf["url"], **kwargs)
+    # Local process-based server
+    if "slowCallWarning" in conf:
+        kwargs["slow_call_warning"] = conf["slowCallWarning"]
+    if "stderrLines" in conf:
+        kwargs["stderr_lines"] = conf["stderrLines"]
+    if "stderrLogRate" in conf:
+        kwargs["stderr_log_rate"] = conf["stderrLogRate"]
+    if "maxMessageBytes" in conf:
+        kwargs["max_message_bytes"] = conf["maxMessageBytes"]
+    return StdioMCP(
+        server_name=server_name,
+        command=conf.get("command"),
+        args=conf.get("args", []),
+        env=conf.get("env", {}),
+        cwd=conf.get("cwd", None),
+        **kwargs
+    )
+
+
+async def start_server(server_name: str, client, timeout: float):
+    """
+    Start one server and list its tools within a single deadline.
+
+    Returns a startup report entry: {"ok", "elapsed", "tools", "error"}.
+    """
+    start = time.perf_counter()
+
+    async def _bring_up():
+        if not await client.start():
+            return None
+        return await client.list_tools()
+
+    try:
+        tools = await asyncio.wait_for(_bring_up(), timeout)
+        error = None if tools is not None else "start failed"
+    except asyncio.TimeoutError:
+        tools, error = None, f"startup timed out after {timeout}s"
+    except Exception as e:
+        tools, error = None, str(e)
+    except asyncio.CancelledError:
+        # 被取消（例如后台任务随 agent 关闭）时不留下半启动的进程
+        await client.stop()
+        raise
+
+    if tools is None:
+        try:
+            await client.stop()
+        except Exception:
+            pass
+    return {
+        "ok": tools is not None,
+        "elapsed": time.perf_counter() - start,
+        "tools": tools or [],
+        "error": error
+    }
+
+
+def config_key(server_name: str, conf: dict) -> str:
+    """Hash identifying a server by its name and connection settings (command, args, env, cwd, url)."""
+    relevant = {k: v for k, v in conf.items() if k not in _AGENT_ONLY_KEYS}
+    data = json.dumps([server_name, relevant], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class _PoolEntry:
+    __slots__ = ("key", "client", "refs", "released_at", "starting", "healthy")
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.refs = 0
+        self.released_at = time.monotonic()
+        self.starting = None # 启动中的 Future，同时到来的 acquire 共享一次启动
+        self.healthy = True
+
+
+class ServerPool:
+    """
+    Process-wide pool keeping MCP servers warm across agents and queries.
+
+    acquire() returns a running client for a config entry, starting it only
+    if no healthy one is pooled; release() drops the reference. Servers
+    without references are stopped after idle_timeout seconds, and idle
+    servers are pinged every health_interval seconds and replaced if they
+    stop answering.
+    """
+    def __init__(self, idle_timeout: float = 300, health_interval: float = 30, ping_timeout: float = 5):
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self._entries: Dict[str, _PoolEntry] = {}
+        self._by_client = {} # id(client) -> entry
+        self._reaper = None
+        self._stopping = set() # 正在关闭的任务，保持引用直到完成
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def acquire(self, server_name: str, conf: dict, timeout: float = 30):
+        """
+        Borrow a started client for this server. Returns (client, report);
+        client is None if the server could not be started.
+        """
+        self._ensure_reaper()
+        key = config_key(server_name, conf)
+        while True:
+            entry = self._entries.get(key)
+            if entry is None:
+                break
+            if entry.starting is not None:
+                await asyncio.shield(entry.starting)
+                continue
+            if entry.healthy and entry.client.is_alive():
+                entry.refs += 1
+                return entry.client, {"ok": True, "elapsed": 0.0, "tools": entry.client.tools,
+                                      "error": None, "pooled": True}
+            # 失效的服务器：移出池，无人引用时停止
+            self._discard(entry)
+            break
+
+        client = create_client(server_name, conf)
+        entry = _PoolEntry(key, client)
+        entry.starting = asyncio.get_running_loop().create_future()
+        self._entries[key] = entry
+        try:
+            report = await start_server(server_name, client, timeout)
+        except BaseException:
+            self._entries.pop(key, None)
+            self._stop_client(client)
+            raise
+        finally:
+            entry.starting.set_result(None)
+            entry.starting = None
+        if not report["ok"]:
+            self._entries.pop(key, None)
+            return None, report
+        entry.refs = 1
+        self._by_client[id(client)] = entry
+        return client, {**report, "pooled": False}
+
+    def release(self, client):
+        """Return a client obtained from acquire()."""
+        entry = self._by_client.get(id(client))
+        if entry is None:
+            return
+        entry.refs = max(0, entry.refs - 1)
+        entry.released_at = time.monotonic()
+        if entry.refs == 0 and (not entry.healthy or self._entries.get(entry.key) is not entry):
+            self._stop_later(entry)
+
+    def owns(self, client) -> bool:
+        return id(client) in self._by_client
+
+    def _discard(self, entry: _PoolEntry):
+        entry.healthy = False
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        if entry.refs == 0:
+            self._stop_later(entry)
+
+    def _stop_later(self, entry: _PoolEntry):
+        self._by_client.pop(id(entry.client), None)
+        self._stop_client(entry.client)
+
+    def _stop_client(self, client):
+        task = asyncio.create_task(client.stop())
+        self._stopping.add(task)
+        task.add_done_callback(self._stopping.discard)
+
+    async def _reap_loop(self):
+        interval = max(1.0, min(self.idle_timeout, self.health_interval) / 2)
+        last_check = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            check_health = now - last_check >= self.health_interval
+            if check_health:
+                last_check = now
+            for entry in list(self._entries.values()):
+                if entry.starting is not None or entry.refs:
+                    continue
+                if now - entry.released_at >= self.idle_timeout:
+                    logger.info(f"Server {entry.client.server_name}: Stopping idle pooled server")
+                    self._discard(entry)
+                elif check_health and not await entry.client.ping(self.ping_timeout):
+                    logger.warning(f"Server {entry.client.server_name}: Pooled server failed health check")
+                    self._discard(entry)
+
+    def stats(self) -> Dict:
+        return {
+            "servers": len(self._entries),
+            "in_use": sum(1 for e in self._entries.values() if e.refs),
+            "refs": sum(e.refs for e in self._entries.values())
+        }
+
+    async def close(self):
+        """Stop every pooled server, in use or not."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        entries = list(self._entries.values())
+        self._entries.clear()
+        self._by_client.clear()
+        await asyncio.gather(*[e.client.stop() for e in entries if e.starting is None],
+                             *self._stopping, return_exceptions=True)
+
+
+_default_pool = None
+
+
+def get_server_pool() -> ServerPool:
+    """The shared, process-wide server pool."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ServerPool()
+    return _default_pool
@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import codec
+
+def _is_error_result(result) -> bool:
+    return isinstance(result, dict) and ("error" in result or result.get("isError"))
+
+
+class ToolResultCache:
+    """
+    Opt-in cache for results of read-only MCP tools.
+
+    Only tools registered through configure() are cached. Entries are keyed on
+    server, tool and canonicalized arguments, expire after their TTL and are
+    evicted least-recently-used once max_entries or max_bytes is exceeded.
+    Concurrent identical calls share a single in-flight request.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (expires_at, size, result)
+        self._inflight = {} # key -> asyncio.Future
+        self._policies = {} # server_name -> {tool_name: ttl}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def configure(self, server_name: str, cache_tools, default_ttl: float = 300):
+        """
+        Register the cacheable tools of a server.
+
+        cache_tools is the "cacheTools" entry of the server config: either a
+        list of tool names (cached for default_ttl seconds) or a mapping of
+        tool name to TTL in seconds.
+        """
+        if not cache_tools:
+            self._policies.pop(server_name, None)
+            return
+        if isinstance(cache_tools, dict):
+            policy = {name: float(ttl) for name, ttl in cache_tools.items()}
+        else:
+            policy = {name: float(default_ttl) for name in cache_tools}
+        self._policies[server_name] = policy
+
+    def ttl_for(self, server_name: str, tool_name: str) -> Optional[float]:
+        return self._policies.get(server_name, {}).get(tool_name)
+
+    @staticmethod
+    def make_key(server_name: str, tool_name: str, arguments: dict):
+        canonical = codec.dumps(arguments, sort_keys=True)
+        return (server_name, tool_name, canonical)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, result = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _put(self, key, result, ttl: float):
+        size = len(codec.dumpb(result))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, result)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def call(self, server_name: str, tool_name: str, arguments: dict, call_tool):
+        """
+        Return the cached result for this call, or await call_tool(tool_name, arguments).
+
+        Tools without a cache policy are passed straight through. Error
+        results are never cached. Concurrent identical calls share one
+        request; if its caller is cancelled, the others retry on their own.
+        """
+        ttl = self.ttl_for(server_name, tool_name)
+        if ttl is None:
+            return await call_tool(tool_name, arguments)
+
+        key = self.make_key(server_name, tool_name, arguments)
+        while True:
+            entry = self._get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[2]
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            self.coalesced += 1
+            # wait() 不会把本任务的取消传给共享的请求，也不会因为发起者被取消而抛出
+            await asyncio.wait((inflight,))
+            if not inflight.cancelled():
+                return inflight.result()
+            # 发起请求的调用者被取消了：本调用者没有被取消，重新查找或自己发起请求
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await call_tool(tool_name, arguments)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # mark the exception as retrieved in case nobody else is waiting
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        if not _is_error_result(result):
+            self._put(key, result, ttl)
+        fut.set_result(result)
+        return result
+
+    def invalidate(self, server_name: str = None):
+        """Drop all entries, or only the entries of one server."""
+        for key in list(self._entries):
+            if server_name is None or key[0] == server_name:
+                self._remove(key)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0
+        }
@@ -0,0 +1,82 @@
+import math
+import re
+
+from typing import Dict, List, Tuple
+
+# 英文按单词/驼峰拆分，中文按单字和相邻双字切分
+_WORD_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+|[\u3400-\u9fff]+")
+_CJK_RE = re.compile(r"[\u3400-\u9fff]")
+
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "get", "how", "i", "if",
+    "in", "into", "is", "it", "me", "my", "of", "on", "or", "please", "that", "the", "this", "to", "use",
+    "what", "when", "which", "with", "you", "your",
+    "的", "了", "是", "我", "你", "在", "和", "吗", "呢", "请",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for word in _WORD_RE.findall(text or ""):
+        if _CJK_RE.match(word):
+            tokens.extend(c for c in word if c not in _STOPWORDS)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            continue
+        word = word.lower()
+        if word in _STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class ToolIndex:
+    """
+    BM25 index over the LLM function definitions of the agent.
+
+    Each function is indexed by its name (weighted twice), description and
+    parameter names; search() returns the names of the best matching
+    functions for a query.
+    """
+    def __init__(self, functions: List[Dict], k1: float = 1.2, b: float = 0.75, name_weight: int = 2):
+        self.k1 = k1
+        self.b = b
+        self.names = [f["name"] for f in functions]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = []
+        for i, f in enumerate(functions):
+            params = (f.get("parameters") or {}).get("properties") or {}
+            tokens = tokenize(f["name"]) * name_weight + tokenize(f.get("description") or "")
+            tokens += tokenize(" ".join(params))
+            lengths.append(len(tokens))
+            counts = {}
+            for t in tokens:
+                counts[t] = counts.get(t, 0) + 1
+            for t, tf in counts.items():
+                self._postings.setdefault(t, []).append((i, tf))
+        self._lengths = lengths
+        self._avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+        n = len(functions)
+        self._idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self._postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def scores(self, query: str) -> Dict[int, float]:
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = self._idf[term]
+            for i, tf in postings:
+                norm = 1 - self.b + self.b * self._lengths[i] / (self._avg_length or 1)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return scores
+
+    def search(self, query: str, k: int) -> List[str]:
+        """Names of the k best matching functions, best first; empty if nothing matches."""
+        scores = self.scores(query)
+        best = sorted(scores, key=lambda i: (-scores[i], i))[:k]
+        return [self.names[i] for i in best]
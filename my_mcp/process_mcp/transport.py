@@ -1,45 +1,314 @@
 import asyncio
+import collections
 import os
-import json
+import random
 
 import logging
+import time
 
+import anyio
+import httpx
 from mcp.client.sse import sse_client
 from mcp import ClientSession
+from mcp.shared.exceptions import McpError
+from mcp import types as mcp_types
+from mcp.types import CONNECTION_CLOSED
+try:
+    from mcp.client.streamable_http import streamablehttp_client
+except ImportError:
+    # older mcp versions only support SSE
+    streamablehttp_client = None
+
+import codec
+from process_mcp.circuit_breaker import CircuitBreaker
+from metrics import TOOL_CALL_SECONDS, TOOL_CALLS_TOTAL, MCP_REQUEST_SECONDS
 
 logger = logging.getLogger("my_mcp")
 
+# 工具调用的默认截止时间（秒），可在配置中按服务器（callTimeout）和按工具（toolTimeouts）覆盖
+DEFAULT_CALL_TIMEOUT = 300
+
+
+def _call_timeout(client, tool_name: str, timeout: float = None) -> float:
+    """Deadline of one call: explicit timeout, else the tool's own, else the server's."""
+    if timeout is not None:
+        return timeout
+    return (client.tool_timeouts or {}).get(tool_name, client.call_timeout)
+
+
 class SSEMCP:
-    def __init__(self, server_name: str, url: str):
+    """
+    Client for a remote MCP server over SSE.
+
+    The connection is owned by a background task that re-connects with
+    exponential backoff when it drops (detected through transport errors,
+    failed calls or a periodic ping), re-initializes the session and
+    replays tools/list. Calls made while reconnecting wait for the new
+    session; a call that failed because the connection broke is retried
+    once on it. All concurrent calls share the one session.
+
+    Each call has a deadline (call_timeout, or per tool in tool_timeouts);
+    a call that times out or is cancelled sends notifications/cancelled
+    to the server, and repeated timeouts open the circuit breaker.
+    """
+    transport = "sse"
+
+    def __init__(self, server_name: str, url: str, headers: dict = None,
+                 timeout: float = 5, sse_read_timeout: float = 300,
+                 max_connections: int = 20, max_keepalive_connections: int = 10, keepalive_expiry: float = 30.0,
+                 reconnect_delay: float = 0.5, max_reconnect_delay: float = 30.0,
+                 max_reconnect_attempts: int = 10, reconnect_wait: float = 30.0, ping_interval: float = 30.0,
+                 call_timeout: float = DEFAULT_CALL_TIMEOUT, tool_timeouts: dict = None,
+                 breaker_threshold: int = 3, breaker_reset: float = 30.0):
         self.server_name = server_name
         self.url = url
+        self.headers = headers
+        # HTTP 配置：请求超时、SSE 读超时、连接池和 keep-alive
+        self.timeout = timeout
+        self.sse_read_timeout = sse_read_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        # 重连配置：退避的初始/最大间隔、连续失败多少次后放弃、调用等待重连的最长时间、心跳间隔
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self.reconnect_wait = reconnect_wait
+        self.ping_interval = ping_interval
+        # 调用截止时间和熔断配置
+        self.call_timeout = call_timeout
+        self.tool_timeouts = tool_timeouts or {}
+        self.breaker = CircuitBreaker(server_name, breaker_threshold, breaker_reset)
+        self._background = set() # 发送中的取消通知
         self.tools = []
-        self._streams_context = None
-        self._session_context = None
         self.session = None
+        self.reconnects = 0
+        self._session_closed = None # 当前会话结束时完成的 Future，用于结束仍在等待响应的请求
+        self._task = None
+        self._ready = None
+        self._closing = None
+        self._connected = None
+        self._lost = None
+        # 服务器发送 notifications/tools/list_changed 时依次调用，参数为 server_name
+        self.tools_changed_callbacks = []
+        # 工具调用并发限制，由使用者设置；共享同一客户端的 agent 共用它
+        self.call_semaphore = None
+
+    def _notify_tools_changed(self):
+        for callback in list(self.tools_changed_callbacks):
+            callback(self.server_name)
+
+    async def _handle_message(self, message):
+        if isinstance(message, RuntimeError) and "unknown request ID" in str(message):
+            # 已超时或取消的请求迟到的响应，连接本身正常
+            logger.debug(f"Server {self.server_name}: Ignoring late response: {str(message)}")
+            return
+        if isinstance(message, Exception):
+            # 传输层错误（例如 SSE 流断开）由 mcp 以异常的形式交给 message_handler
+            logger.warning(f"Server {self.server_name}: Transport error: {str(message)}")
+            self._mark_lost()
+            return
+        method = getattr(getattr(message, "root", None), "method", None)
+        if method == "notifications/tools/list_changed":
+            self._notify_tools_changed()
 
-    async def start(self):
-        try:
-            # 建立sse连接
-            self._streams_context = sse_client(url=self.url)
-            streams = await self._streams_context.__aenter__()
+    def _mark_lost(self):
+        if self._lost is not None and self.session is not None:
+            self._lost.set()
 
-            # 创建客户端会话
-            self._session_context = ClientSession(*streams)
-            self.session = await self._session_context.__aenter__()
+    def _create_session(self, streams):
+        try:
+            return ClientSession(*streams, message_handler=self._handle_message)
+        except TypeError:
+            # older mcp versions have no message_handler
+            return ClientSession(*streams)
+
+    def _http_client_factory(self, headers=None, timeout=None, auth=None):
+        kwargs = {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            "timeout": timeout or httpx.Timeout(self.timeout, read=self.sse_read_timeout)
+        }
+        if headers is not None:
+            kwargs["headers"] = headers
+        if auth is not None:
+            kwargs["auth"] = auth
+        return httpx.AsyncClient(**kwargs)
+
+    def _connect(self):
+        """Async context manager yielding (read_stream, write_stream, ...)."""
+        try:
+            return sse_client(url=self.url, headers=self.headers, timeout=self.timeout,
+                              sse_read_timeout=self.sse_read_timeout,
+                              httpx_client_factory=self._http_client_factory)
+        except TypeError:
+            # older mcp versions have no httpx_client_factory
+            return sse_client(url=self.url, headers=self.headers, timeout=self.timeout,
+                              sse_read_timeout=self.sse_read_timeout)
+
+    async def _watch(self, session):
+        """Wait until stop() is called or the connection is lost; pings periodically."""
+        closing = asyncio.ensure_future(self._closing.wait())
+        lost = asyncio.ensure_future(self._lost.wait())
+        try:
+            while True:
+                done, _ = await asyncio.wait({closing, lost}, timeout=self.ping_interval,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if done:
+                    return
+                try:
+                    await asyncio.wait_for(session.send_ping(), self.timeout)
+                except Exception as e:
+                    logger.warning(f"Server {self.server_name}: Ping failed: {str(e)}")
+                    return
+        finally:
+            closing.cancel()
+            lost.cancel()
+
+    async def _run(self):
+        """
+        Own the connection and the client session for their whole lifetime.
+
+        The mcp/anyio contexts must be entered and exited in the same task, so
+        they live in this background task instead of start()/stop(), which may
+        be awaited from different tasks (e.g. concurrent startup vs. cleanup).
+        """
+        attempt = 0
+        connected_once = False
+        try:
+            while not self._closing.is_set():
+                try:
+                    async with self._connect() as streams:
+                        async with self._create_session(streams[:2]) as session:
+                            await asyncio.wait_for(session.initialize(), self.reconnect_wait)
+                            self._lost.clear()
+                            self._session_closed = asyncio.get_running_loop().create_future()
+                            self.session = session
+                            if connected_once:
+                                self.reconnects += 1
+                                logger.info(f"Server {self.server_name}: Reconnected")
+                                await self._replay_tools()
+                            connected_once = True
+                            attempt = 0
+                            self._connected.set()
+                            self._ready.set()
+                            await self._watch(session)
+                except Exception as e:
+                    logger.error(f"Server {self.server_name}: {self.transport} connection error: {str(e)}")
+                finally:
+                    self.session = None
+                    self._connected.clear()
+                    if self._session_closed is not None and not self._session_closed.done():
+                        self._session_closed.set_result(None)
+                if self._closing.is_set() or not connected_once:
+                    return
+                attempt += 1
+                if self.max_reconnect_attempts is not None and attempt > self.max_reconnect_attempts:
+                    logger.error(f"Server {self.server_name}: Giving up after {attempt - 1} reconnect attempts")
+                    return
+                delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning(f"Server {self.server_name}: Connection lost, reconnecting in {delay:.1f}s")
+                try:
+                    await asyncio.wait_for(self._closing.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._ready.set()
+
+    async def _replay_tools(self):
+        previous = self.tools
+        tools = await self.list_tools()
+        if tools and tools != previous:
+            self._notify_tools_changed()
+
+    async def _wait_connected(self, timeout: float, stale=None):
+        """
+        The current session, waiting up to timeout for a reconnect; None if
+        unavailable. stale is a session known to be broken that must not be
+        returned again.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # 断开的会话要等后台任务把它清掉：清理时会完成该会话的 _session_closed
+        if stale is not None and self.session is stale:
+            if self._task is None or self._task.done():
+                return None
+            await asyncio.wait({self._session_closed, self._task}, timeout=max(0.0, deadline - loop.time()),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if self.session is stale:
+                return None
+        if self.session is not None and self.session is not stale:
+            return self.session
+        if self._task is None or self._task.done():
+            return None
+        waiter = asyncio.ensure_future(self._connected.wait())
+        try:
+            await asyncio.wait({waiter, self._task}, timeout=max(0.0, deadline - loop.time()),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        return self.session if self.session is not stale else None
+
+    async def _on_session(self, coro):
+        """
+        Await a request on the current session, failing with ConnectionError
+        if the session is torn down first (its pending requests would
+        otherwise never get an answer).
+        """
+        closed = self._session_closed
+        request = asyncio.ensure_future(coro)
+        if closed is None:
+            return await request
+        try:
+            await asyncio.wait({request, closed}, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            request.cancel()
+            raise
+        if not request.done():
+            request.cancel()
+            raise ConnectionError("connection closed")
+        return request.result()
+
+    @staticmethod
+    def _is_connection_error(e: Exception) -> bool:
+        if isinstance(e, McpError):
+            return getattr(e.error, "code", None) == CONNECTION_CLOSED
+        return isinstance(e, (anyio.ClosedResourceError, anyio.BrokenResourceError,
+                              anyio.EndOfStream, httpx.TransportError, ConnectionError))
 
-            # Initialize 初始化会话
-            await self.session.initialize()
+    async def start(self):
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._lost = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        await self._ready.wait()
+        return self.session is not None
+
+    def is_alive(self):
+        # 重连期间仍视为存活；放弃重连后后台任务结束
+        return self._task is not None and not self._task.done()
+
+    async def ping(self, timeout: float = 5.0):
+        if not self.session:
+            return False
+        try:
+            await asyncio.wait_for(self._on_session(self.session.send_ping()), timeout)
             return True
         except Exception as e:
-            logger.error(f"Server {self.server_name}: SSE connection error: {str(e)}")
+            if self._is_connection_error(e):
+                self._mark_lost()
             return False
 
     async def list_tools(self):
         if not self.session:
             return []
         try:
-            response = await self.session.list_tools()
+            response = await self._on_session(self.session.list_tools())
             # 将 pydantic 模型转换为字典格式
             self.tools = [
                 {
@@ -52,66 +321,297 @@ class SSEMCP:
             ]
             return self.tools
         except Exception as e:
+            if self._is_connection_error(e):
+                self._mark_lost()
             logger.error(f"Server {self.server_name}: List tools error: {str(e)}")
             return []
 
-    async def call_tool(self, tool_name: str, arguments: dict):
-        if not self.session:
-            return {"error": "Not connected"}
+    @staticmethod
+    async def _send_call(session, tool_name: str, arguments: dict, sent: list):
+        # send_request 在第一次 await 之前分配请求 id，此处记录下来以便取消
+        sent.append(getattr(session, "_request_id", None))
+        return await session.call_tool(tool_name, arguments)
+
+    def _notify_cancelled(self, session, request_id, reason: str):
+        """Tell the server to stop working on a request we no longer wait for."""
+        if session is None or request_id is None or self.session is not session:
+            return
+        note = mcp_types.ClientNotification(mcp_types.CancelledNotification(
+            params=mcp_types.CancelledNotificationParams(requestId=request_id, reason=reason)))
+
+        async def _send():
+            try:
+                await asyncio.wait_for(session.send_notification(note), 5)
+            except Exception as e:
+                logger.debug(f"Server {self.server_name}: Could not send cancellation: {str(e)}")
+
+        # 调用者可能正被取消，通知在独立任务中发送
+        task = asyncio.ensure_future(_send())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def call_tool(self, tool_name: str, arguments: dict, timeout: float = None):
+        if not self.breaker.allow():
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport=self.transport, status="rejected")
+            return self.breaker.rejection()
+        start = time.perf_counter()
+        timeout = _call_timeout(self, tool_name, timeout)
+        deadline = start + timeout
+        session = None
+        sent = []
         try:
-            response = await self.session.call_tool(tool_name, arguments)
-            # 将 pydantic 模型转换为字典格式
-            return response.model_dump() if hasattr(response, 'model_dump') else response
-        except Exception as e:
-            logger.error(f"Server {self.server_name}: Tool call error: {str(e)}")
-            return {"error": str(e)}
+            for attempt in range(2):
+                session = await self._wait_connected(min(self.reconnect_wait, max(0.0, deadline - time.perf_counter())),
+                                                     stale=session)
+                if session is None:
+                    self.breaker.release()
+                    TOOL_CALLS_TOTAL.inc(server=self.server_name, transport=self.transport, status="error")
+                    return {"error": "Not connected"}
+                sent.clear()
+                try:
+                    response = await asyncio.wait_for(
+                        self._on_session(self._send_call(session, tool_name, arguments, sent)),
+                        max(0.0, deadline - time.perf_counter()))
+                    self.breaker.record_success()
+                    TOOL_CALL_SECONDS.observe(time.perf_counter() - start, server=self.server_name, transport=self.transport)
+                    TOOL_CALLS_TOTAL.inc(server=self.server_name, transport=self.transport, status="ok")
+                    # 将 pydantic 模型转换为字典格式
+                    return response.model_dump() if hasattr(response, 'model_dump') else response
+                except asyncio.TimeoutError:
+                    self._notify_cancelled(session, sent[0] if sent else None, f"timed out after {timeout}s")
+                    self.breaker.record_timeout()
+                    TOOL_CALLS_TOTAL.inc(server=self.server_name, transport=self.transport, status="timeout")
+                    logger.error(f"Server {self.server_name}: Tool {tool_name} timed out after {timeout}s")
+                    return {"error": f"Timeout waiting for tool result after {timeout}s"}
+                except Exception as e:
+                    if attempt == 0 and self._is_connection_error(e):
+                        # 连接断开：等待重连后在新会话上重试一次
+                        logger.warning(f"Server {self.server_name}: Connection lost during {tool_name}, retrying")
+                        if self.session is session:
+                            self._mark_lost()
+                        continue
+                    self.breaker.release()
+                    TOOL_CALLS_TOTAL.inc(server=self.server_name, transport=self.transport, status="error")
+                    logger.error(f"Server {self.server_name}: Tool call error: {str(e)}")
+                    return {"error": str(e)}
+        except asyncio.CancelledError:
+            self._notify_cancelled(session, sent[0] if sent else None, "cancelled by the client")
+            self.breaker.release()
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport=self.transport, status="cancelled")
+            raise
 
     async def stop(self):
-        if self.session:
-            await self._session_context.__aexit__(None, None, None)
-        if self._streams_context:
-            await self._streams_context.__aexit__(None, None, None)
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        if self.session is None:
+            # still connecting, initializing or waiting to reconnect
+            task.cancel()
+        self._closing.set()
+        try:
+            await asyncio.wait_for(task, timeout=5.0)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+
+
+class StreamableHTTPMCP(SSEMCP):
+    """Client for a remote MCP server over the streamable-HTTP transport."""
+    transport = "streamable_http"
 
+    def __init__(self, server_name: str, url: str, timeout: float = 30, **kwargs):
+        super().__init__(server_name, url, timeout=timeout, **kwargs)
+
+    def _connect(self):
+        if streamablehttp_client is None:
+            raise RuntimeError("the installed mcp package does not support the streamable-HTTP transport")
+        return streamablehttp_client(url=self.url, headers=self.headers, timeout=self.timeout,
+                                     sse_read_timeout=self.sse_read_timeout,
+                                     httpx_client_factory=self._http_client_factory)
 
 
 class StdioMCP:
-    def __init__(self, server_name, command, args=None, env=None, cwd=None):
+    def __init__(self, server_name, command, args=None, env=None, cwd=None,
+                 max_message_bytes=256 * 1024 * 1024,
+                 read_chunk_size=256 * 1024,
+                 offload_decode_bytes=1024 * 1024,
+                 call_timeout=DEFAULT_CALL_TIMEOUT, tool_timeouts=None, slow_call_warning=5,
+                 breaker_threshold=3, breaker_reset=30.0,
+                 stderr_lines=200, stderr_line_bytes=4096, stderr_log_rate=20):
         self.server_name = server_name
         self.command = command
         self.args = args
         self.env = env
         self.cwd = cwd
+        # 读取配置：单条消息上限、每次读取的块大小、超过多大的消息在线程中解析
+        self.max_message_bytes = max_message_bytes
+        self.read_chunk_size = read_chunk_size
+        self.offload_decode_bytes = offload_decode_bytes
+        # 调用截止时间、慢调用告警和熔断配置
+        self.call_timeout = call_timeout
+        self.tool_timeouts = tool_timeouts or {}
+        self.slow_call_warning = slow_call_warning
+        self.breaker = CircuitBreaker(server_name, breaker_threshold, breaker_reset)
+        # stderr 配置：保留的最近行数、每行最多保留的字节数、每秒最多写入日志的行数
+        self.stderr_line_bytes = stderr_line_bytes
+        self.stderr_log_rate = stderr_log_rate
+        self._stderr_tail = collections.deque(maxlen=stderr_lines)
+        self.stderr_task = None
         # ---------- #
         self.process = None # 子进程
         self.tools = []
         self.request_id = 0
         self.protocol_version = "2024-11-05"
         self.receive_task = None
-        self.responses = {}
+        self._pending = {} # JSON-RPC id -> asyncio.Future，由 _process_message 直接完成
+        self._receive_closed = None # 接收循环结束的原因
         self.server_capabilities = {}
         self._shutdown = False
         self._cleanup_lock = asyncio.Lock()
+        # 服务器发送 notifications/tools/list_changed 时依次调用，参数为 server_name
+        self.tools_changed_callbacks = []
+        # 工具调用并发限制，由使用者设置；共享同一客户端的 agent 共用它
+        self.call_semaphore = None
+
+    async def _decode(self, line: bytearray):
+        if len(line) >= self.offload_decode_bytes:
+            # 大消息在工作线程中解析，避免阻塞其它服务器
+            return await asyncio.to_thread(codec.loads, line)
+        return codec.loads(line)
 
     async def _receive_loop(self):
+        """
+        Read newline-delimited JSON-RPC messages from the server.
+
+        Frames are split manually from fixed-size reads instead of using
+        StreamReader.readline(), whose 64 KiB limit breaks on large tool
+        results. When the stream ends or breaks, every pending request fails
+        with ConnectionError instead of waiting for its timeout.
+        """
         if not self.process or self.process.stdout.at_eof():
+            self._close_pending("stdout is closed")
             return
+        reader = self.process.stdout
+        buffer = bytearray()
+        scan_from = 0
+        reason = "server closed its stdout"
         try:
-            while not self.process.stdout.at_eof():
-                line = await self.process.stdout.readline()
-                if not line:
+            while True:
+                chunk = await reader.read(self.read_chunk_size)
+                if not chunk:
+                    break
+                buffer += chunk
+                while True:
+                    idx = buffer.find(b"\n", scan_from)
+                    if idx < 0:
+                        scan_from = len(buffer)
+                        break
+                    line = buffer[:idx]
+                    del buffer[:idx + 1]
+                    scan_from = 0
+                    if not line.strip():
+                        continue
+                    try:
+                        message = await self._decode(line)
+                    except codec.DecodeError:
+                        logger.warning(f"Server {self.server_name}: Ignoring non-JSON line on stdout")
+                        continue
+                    if isinstance(message, dict):
+                        self._process_message(message)
+                if len(buffer) > self.max_message_bytes:
+                    reason = f"message larger than {self.max_message_bytes} bytes"
+                    logger.error(f"Server {self.server_name}: Receive error: {reason}")
                     break
+        except asyncio.CancelledError:
+            reason = "client is shutting down"
+            raise
+        except Exception as e:
+            reason = f"receive error: {str(e)}"
+            logger.error(f"Server {self.server_name}: {reason}")
+        finally:
+            self._close_pending(reason)
+        if not self._shutdown:
+            # 服务器意外退出：stderr 中通常有原因，等读取任务取完剩余输出
+            if self.stderr_task and not self.stderr_task.done():
                 try:
-                    message = json.loads(line.decode().strip())
-                    self._process_message(message)
-                except json.JSONDecodeError:
+                    await asyncio.wait_for(asyncio.shield(self.stderr_task), 0.5)
+                except asyncio.TimeoutError:
                     pass
-        except Exception:
-            pass
+            self._log_stderr_tail()
+
+    async def _stderr_loop(self):
+        """
+        Drain the server's stderr for as long as it runs.
+
+        Nothing else reads the pipe, so without this a chatty server fills
+        the OS buffer and blocks on its own logging, stalling every call.
+        The last lines are kept in a ring buffer (stderr_tail()) and logged
+        at DEBUG level, at most stderr_log_rate lines per second; the number
+        of lines left out of the log is reported once the rate allows again.
+        """
+        reader = self.process.stderr
+        buffer = bytearray()
+        window_start = 0.0
+        logged = 0
+        suppressed = 0
+        try:
+            while True:
+                chunk = await reader.read(self.read_chunk_size)
+                if not chunk:
+                    break
+                buffer += chunk
+                lines = buffer.split(b"\n")
+                buffer = bytearray(lines.pop())
+                if len(buffer) > self.stderr_line_bytes:
+                    # 没有换行的超长输出按一行截断处理
+                    lines.append(bytes(buffer))
+                    buffer.clear()
+                now = time.monotonic()
+                for raw in lines:
+                    line = raw[:self.stderr_line_bytes].decode("utf-8", errors="replace").rstrip()
+                    if not line:
+                        continue
+                    self._stderr_tail.append(line)
+                    if now - window_start >= 1.0:
+                        if suppressed:
+                            logger.debug(f"Server {self.server_name}: {suppressed} stderr lines not logged")
+                        window_start, logged, suppressed = now, 0, 0
+                    if logged < self.stderr_log_rate:
+                        logged += 1
+                        logger.debug(f"Server {self.server_name} stderr: {line}")
+                    else:
+                        suppressed += 1
+            if buffer.strip():
+                self._stderr_tail.append(buffer[:self.stderr_line_bytes].decode("utf-8", errors="replace").rstrip())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Server {self.server_name}: stderr reader stopped: {str(e)}")
+
+    def stderr_tail(self, lines: int = None) -> str:
+        """The last lines the server wrote to stderr (all buffered lines by default)."""
+        tail = list(self._stderr_tail)
+        if lines is not None:
+            tail = tail[-lines:] if lines > 0 else []
+        return "\n".join(tail)
+
+    def _log_stderr_tail(self, lines: int = 20):
+        tail = self.stderr_tail(lines)
+        if tail:
+            logger.warning(f"Server {self.server_name}: last stderr output:\n{tail}")
+
+    def _close_pending(self, reason: str):
+        self._receive_closed = reason
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError(f"Server {self.server_name}: {reason}"))
 
     def _process_message(self, message: dict):
         if "jsonrpc" in message and "id" in message:
             if "result" in message or "error" in message:
-                self.responses[message["id"]] = message
+                fut = self._pending.pop(message["id"], None)
+                if fut and not fut.done():
+                    fut.set_result(message)
             else:
                 # request from server, not implemented
                 resp = {
@@ -125,7 +625,9 @@ class StdioMCP:
                 asyncio.create_task(self._send_message(resp))
         elif "jsonrpc" in message and "method" in message and "id" not in message:
             # notification from server
-            pass
+            if message["method"] == "notifications/tools/list_changed":
+                for callback in list(self.tools_changed_callbacks):
+                    callback(self.server_name)
 
     async def start(self):
         expanded_args = []
@@ -147,125 +649,201 @@ class StdioMCP:
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 env=env_vars,
-                cwd=self.cwd
+                cwd=self.cwd,
+                limit=self.read_chunk_size
             )
+            self.stderr_task = asyncio.create_task(self._stderr_loop())
             self.receive_task = asyncio.create_task(self._receive_loop())
-            return await self._perform_initialize()
-        except Exception:
-            return False
+            if await self._perform_initialize():
+                return True
+        except Exception as e:
+            logger.error(f"Server {self.server_name}: Failed to start: {str(e)}")
+        if not self._receive_closed:
+            # 接收循环结束时已经输出过 stderr
+            self._log_stderr_tail()
+        return False
 
-    async def _perform_initialize(self):
+    async def _request(self, method: str, params: dict, timeout: float, warn_after: float = None,
+                       cancellable: bool = False):
+        """
+        Send a JSON-RPC request and wait for its response.
+
+        The future registered in self._pending is resolved by _process_message as
+        soon as the matching response arrives, so several requests can be in
+        flight on the same server without polling.
+
+        Raises asyncio.TimeoutError if no response arrives within timeout and
+        ConnectionError if the server's stdout is closed or broken. With
+        cancellable, a request abandoned by timeout or cancellation is
+        announced to the server with notifications/cancelled.
+        """
+        if self._receive_closed:
+            raise ConnectionError(f"Server {self.server_name}: {self._receive_closed}")
         self.request_id += 1
-        req_id = self.request_id
+        rid = self.request_id
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
         req = {
             "jsonrpc": "2.0",
-            "id": req_id,
-            "method": "initialize",
-            "params": {
-                "protocolVersion": self.protocol_version,
-                "capabilities": {"sampling": {}},
-                "clientInfo": {
-                    "name": "DolphinMCPClient",
-                    "version": "1.0.0"
-                }
+            "id": rid,
+            "method": method,
+            "params": params
+        }
+        try:
+            if not await self._send_message(req):
+                return {"jsonrpc": "2.0", "id": rid,
+                        "error": {"code": -32000, "message": "Failed to send request"}}
+            remaining = timeout
+            if warn_after is not None and warn_after < timeout:
+                try:
+                    return await asyncio.wait_for(asyncio.shield(fut), warn_after)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Server {self.server_name}: {method} taking longer than {warn_after}s...")
+                    remaining -= warn_after
+            return await asyncio.wait_for(fut, remaining)
+        except asyncio.TimeoutError:
+            if cancellable:
+                self._notify_cancelled(rid, f"timed out after {timeout}s")
+            raise
+        except asyncio.CancelledError:
+            if cancellable and not fut.done():
+                self._notify_cancelled(rid, "cancelled by the client")
+            raise
+        finally:
+            self._pending.pop(rid, None)
+
+    def _notify_cancelled(self, rid: int, reason: str):
+        """Tell the server to stop working on a request we no longer wait for."""
+        if not self.process or self._shutdown or self._receive_closed:
+            return
+        note = {"jsonrpc": "2.0", "method": "notifications/cancelled",
+                "params": {"requestId": rid, "reason": reason}}
+        try:
+            # 不等待 drain：调用者可能正被取消
+            self.process.stdin.write(codec.dumpb(note) + b"\n")
+        except Exception as e:
+            logger.debug(f"Server {self.server_name}: Could not send cancellation: {str(e)}")
+
+    def is_alive(self):
+        return (self.process is not None and self.process.returncode is None
+                and not self._shutdown and not self._receive_closed)
+
+    async def ping(self, timeout: float = 5.0):
+        """Send an MCP ping; returns False if the server does not answer in time."""
+        if not self.is_alive():
+            return False
+        try:
+            # any answer, even an error for servers without ping support, means it is responsive
+            await self._request("ping", {}, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return False
+        return True
+
+    async def _perform_initialize(self):
+        params = {
+            "protocolVersion": self.protocol_version,
+            "capabilities": {"sampling": {}},
+            "clientInfo": {
+                "name": "DolphinMCPClient",
+                "version": "1.0.0"
             }
         }
-        await self._send_message(req)
 
         start = asyncio.get_event_loop().time()
         timeout = 10  # Increased timeout to 10 seconds
-        while asyncio.get_event_loop().time() - start < timeout:
-            if req_id in self.responses:
-                resp = self.responses[req_id]
-                del self.responses[req_id]
-                if "error" in resp:
-                    logger.error(f"Server {self.server_name}: Initialize error: {resp['error']}")
-                    return False
-                if "result" in resp:
-                    elapsed = asyncio.get_event_loop().time() - start
-                    logger.info(f"Server {self.server_name}: Initialized in {elapsed:.2f}s")
-                    note = {"jsonrpc": "2.0", "method": "notifications/initialized"}
-                    await self._send_message(note)
-                    init_result = resp["result"]
-                    self.server_capabilities = init_result.get("capabilities", {})
-                    return True
-            await asyncio.sleep(0.05)
-        logger.error(f"Server {self.server_name}: Initialize timed out after {timeout}s")
-        return False
+        try:
+            resp = await self._request("initialize", params, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Server {self.server_name}: Initialize timed out after {timeout}s")
+            return False
+        except ConnectionError as e:
+            logger.error(f"Initialize failed: {str(e)}")
+            return False
+        if "error" in resp:
+            logger.error(f"Server {self.server_name}: Initialize error: {resp['error']}")
+            return False
+        elapsed = asyncio.get_event_loop().time() - start
+        MCP_REQUEST_SECONDS.observe(elapsed, server=self.server_name, method="initialize")
+        logger.info(f"Server {self.server_name}: Initialized in {elapsed:.2f}s")
+        note = {"jsonrpc": "2.0", "method": "notifications/initialized"}
+        await self._send_message(note)
+        init_result = resp["result"]
+        self.server_capabilities = init_result.get("capabilities", {})
+        return True
 
     async def list_tools(self):
         if not self.process:
             return []
-        self.request_id += 1
-        rid = self.request_id
-        req = {
-            "jsonrpc": "2.0",
-            "id": rid,
-            "method": "tools/list",
-            "params": {}
-        }
-        await self._send_message(req)
 
         start = asyncio.get_event_loop().time()
         timeout = 10  # Increased timeout to 10 seconds
-        while asyncio.get_event_loop().time() - start < timeout:
-            if rid in self.responses:
-                resp = self.responses[rid]
-                del self.responses[rid]
-                if "error" in resp:
-                    logger.error(f"Server {self.server_name}: List tools error: {resp['error']}")
-                    return []
-                if "result" in resp and "tools" in resp["result"]:
-                    elapsed = asyncio.get_event_loop().time() - start
-                    logger.info(f"Server {self.server_name}: Listed {len(resp['result']['tools'])} tools in {elapsed:.2f}s")
-                    self.tools = resp["result"]["tools"]
-                    return self.tools
-            await asyncio.sleep(0.05)
-        logger.error(f"Server {self.server_name}: List tools timed out after {timeout}s")
-        return []
-
-    async def call_tool(self, tool_name: str, arguments: dict):
+        try:
+            resp = await self._request("tools/list", {}, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Server {self.server_name}: List tools timed out after {timeout}s")
+            return []
+        except ConnectionError as e:
+            logger.error(f"List tools failed: {str(e)}")
+            return []
+        if "error" in resp:
+            logger.error(f"Server {self.server_name}: List tools error: {resp['error']}")
+            return []
+        if "tools" not in resp.get("result", {}):
+            return []
+        elapsed = asyncio.get_event_loop().time() - start
+        MCP_REQUEST_SECONDS.observe(elapsed, server=self.server_name, method="tools/list")
+        logger.info(f"Server {self.server_name}: Listed {len(resp['result']['tools'])} tools in {elapsed:.2f}s")
+        self.tools = resp["result"]["tools"]
+        return self.tools
+
+    async def call_tool(self, tool_name: str, arguments: dict, timeout: float = None):
         if not self.process:
             return {"error": "Not started"}
-        self.request_id += 1
-        rid = self.request_id
-        req = {
-            "jsonrpc": "2.0",
-            "id": rid,
-            "method": "tools/call",
-            "params": {
-                "name": tool_name,
-                "arguments": arguments
-            }
+        if not self.breaker.allow():
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport="stdio", status="rejected")
+            return self.breaker.rejection()
+        params = {
+            "name": tool_name,
+            "arguments": arguments
         }
-        await self._send_message(req)
 
         start = asyncio.get_event_loop().time()
-        timeout = 3600  # Increased timeout to 30 seconds
-        while asyncio.get_event_loop().time() - start < timeout:
-            if rid in self.responses:
-                resp = self.responses[rid]
-                del self.responses[rid]
-                if "error" in resp:
-                    logger.error(f"Server {self.server_name}: Tool {tool_name} error: {resp['error']}")
-                    return {"error": resp["error"]}
-                if "result" in resp:
-                    elapsed = asyncio.get_event_loop().time() - start
-                    logger.info(f"Server {self.server_name}: Tool {tool_name} completed in {elapsed:.2f}s")
-                    return resp["result"]
-            await asyncio.sleep(0.01)  # Reduced sleep interval for more responsive streaming
-            if asyncio.get_event_loop().time() - start > 5:  # Log warning after 5 seconds
-                logger.warning(f"Server {self.server_name}: Tool {tool_name} taking longer than 5s...")
-        logger.error(f"Server {self.server_name}: Tool {tool_name} timed out after {timeout}s")
-        return {"error": f"Timeout waiting for tool result after {timeout}s"}
+        timeout = _call_timeout(self, tool_name, timeout)
+        try:
+            # Log warning once after slow_call_warning seconds
+            resp = await self._request("tools/call", params, timeout, warn_after=self.slow_call_warning,
+                                       cancellable=True)
+        except asyncio.TimeoutError:
+            self.breaker.record_timeout()
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport="stdio", status="timeout")
+            logger.error(f"Server {self.server_name}: Tool {tool_name} timed out after {timeout}s")
+            return {"error": f"Timeout waiting for tool result after {timeout}s"}
+        except ConnectionError as e:
+            self.breaker.release()
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport="stdio", status="error")
+            logger.error(f"Tool {tool_name} failed: {str(e)}")
+            return {"error": str(e)}
+        except asyncio.CancelledError:
+            self.breaker.release()
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport="stdio", status="cancelled")
+            raise
+        self.breaker.record_success()
+        elapsed = asyncio.get_event_loop().time() - start
+        TOOL_CALL_SECONDS.observe(elapsed, server=self.server_name, transport="stdio")
+        if "error" in resp:
+            TOOL_CALLS_TOTAL.inc(server=self.server_name, transport="stdio", status="error")
+            logger.error(f"Server {self.server_name}: Tool {tool_name} error: {resp['error']}")
+            return {"error": resp["error"]}
+        TOOL_CALLS_TOTAL.inc(server=self.server_name, transport="stdio", status="ok")
+        logger.info(f"Server {self.server_name}: Tool {tool_name} completed in {elapsed:.2f}s")
+        return resp["result"]
 
     async def _send_message(self, message: dict):
         if not self.process or self._shutdown:
             logger.error(f"Server {self.server_name}: Cannot send message - process not running or shutting down")
             return False
         try:
-            data = json.dumps(message) + "\n"
-            self.process.stdin.write(data.encode())
+            self.process.stdin.write(codec.dumpb(message) + b"\n")
             await self.process.stdin.drain()
             return True
         except Exception as e:
@@ -287,38 +865,42 @@ class StdioMCP:
 
             if self.process:
                 try:
-                    # Try to send a shutdown notification first
-                    try:
-                        note = {"jsonrpc": "2.0", "method": "shutdown"}
-                        await self._send_message(note)
-                        # Give a small window for the process to react
-                        await asyncio.sleep(0.5)
-                    except:
-                        pass
-
-                    # Close stdin before terminating to prevent pipe errors
+                    # MCP stdio shutdown: close stdin and let the server exit on EOF
                     if self.process.stdin:
                         self.process.stdin.close()
-
-                    # Try graceful shutdown first
-                    self.process.terminate()
                     try:
-                        # Use a shorter timeout to make cleanup faster
-                        await asyncio.wait_for(self.process.wait(), timeout=1.0)
+                        await asyncio.wait_for(self.process.wait(), timeout=0.5)
                     except asyncio.TimeoutError:
-                        # Force kill if graceful shutdown fails
-                        logger.warning(f"Server {self.server_name}: Force killing process after timeout")
-                        self.process.kill()
+                        pass
+
+                    if self.process.returncode is None:
+                        # Try graceful shutdown first
+                        self.process.terminate()
                         try:
                             await asyncio.wait_for(self.process.wait(), timeout=1.0)
                         except asyncio.TimeoutError:
-                            logger.error(f"Server {self.server_name}: Process did not respond to SIGKILL")
+                            # Force kill if graceful shutdown fails
+                            logger.warning(f"Server {self.server_name}: Force killing process after timeout")
+                            self.process.kill()
+                            try:
+                                await asyncio.wait_for(self.process.wait(), timeout=1.0)
+                            except asyncio.TimeoutError:
+                                logger.error(f"Server {self.server_name}: Process did not respond to SIGKILL")
+                except ProcessLookupError:
+                    pass
                 except Exception as e:
                     logger.error(f"Server {self.server_name}: Error during process cleanup: {str(e)}")
                 finally:
                     # Make sure we clear the reference
                     self.process = None
 
+            if self.stderr_task and not self.stderr_task.done():
+                # 进程退出后管道随即关闭，读取任务很快结束
+                try:
+                    await asyncio.wait_for(self.stderr_task, timeout=0.5)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    pass
+
     # Alias close to stop for backward compatibility
     async def close(self):
         await self.stop()
@@ -0,0 +1,388 @@
+"""
+Multi-session HTTP/WebSocket service for MCPAgent.
+
+All sessions share one ServerPool (one set of MCP connections), one pooled
+ChatDeepSeek client and one tool result cache; each session keeps its own
+conversation. Prompts are admitted through a global concurrency limit and a
+session only runs one prompt at a time.
+
+    cd my_mcp
+    python service.py --config mcp_servers_config.json --port 8080
+
+    POST   /sessions                    -> {"session_id": ...}
+    POST   /sessions/{id}/messages      {"query": "...", "stream": false}
+           stream=true answers with server-sent events (data: {"text": ...})
+    DELETE /sessions/{id}
+    WS     /sessions/{id}/ws            send {"query": "..."}, receive chunk/done/error
+    GET    /health, GET /metrics
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import time
+import uuid
+
+from typing import Dict
+
+import logging
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import codec
+from llm.chat_deepseek import ChatDeepSeek
+from llm.scheduler import LLMRequestError, get_llm_scheduler
+from process_mcp.agent import MCPAgent, api_key, base_url
+from process_mcp.pool import ServerPool
+from process_mcp.tool_cache import ToolResultCache
+from metrics import metrics, SERVICE_REQUESTS_TOTAL, SERVICE_QUEUE_SECONDS
+
+logger = logging.getLogger("my_mcp")
+
+
+class ServiceError(Exception):
+    """Request rejected by the session manager; status is the HTTP status to answer with."""
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Session:
+    __slots__ = ("session_id", "agent", "lock", "created_at", "last_used")
+
+    def __init__(self, session_id, agent):
+        self.session_id = session_id
+        self.agent = agent
+        self.lock = asyncio.Lock() # 同一会话一次只处理一个问题
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """
+    Owns the shared resources and the per-session agents.
+
+    max_sessions bounds the number of open sessions, max_concurrent_prompts
+    the number of prompts running at once across all sessions; a prompt that
+    waits longer than queue_timeout for a slot is rejected. Sessions idle for
+    session_idle_timeout seconds are closed.
+    """
+    def __init__(self, mcp_config_path: str, log_dir: str = None,
+                 max_sessions: int = 100, max_concurrent_prompts: int = 16,
+                 queue_timeout: float = 30, session_idle_timeout: float = 1800,
+                 llm_client: ChatDeepSeek = None, server_pool: ServerPool = None,
+                 agent_options: Dict = None):
+        self.mcp_config_path = mcp_config_path
+        self.log_dir = log_dir
+        self.max_sessions = max_sessions
+        self.queue_timeout = queue_timeout
+        self.session_idle_timeout = session_idle_timeout
+        # 只关闭自己创建的 LLM 客户端和服务器池，传入的由调用者负责
+        self._close_llm = llm_client is None
+        self._close_pool = server_pool is None
+        self.llm = llm_client if llm_client is not None else ChatDeepSeek(api_key=api_key, base_url=base_url)
+        self.server_pool = server_pool if server_pool is not None else ServerPool()
+        self.tool_cache = ToolResultCache()
+        self.agent_options = agent_options or {}
+        self._prompt_slots = asyncio.Semaphore(max(1, max_concurrent_prompts))
+        self._sessions: Dict[str, _Session] = {}
+        self._creating = 0
+        self._reaper = None
+
+    async def start(self):
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+        self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def create_session(self) -> _Session:
+        if len(self._sessions) + self._creating >= self.max_sessions:
+            raise ServiceError(503, f"Too many sessions (max {self.max_sessions})")
+        session_id = uuid.uuid4().hex
+        log_path = os.path.join(self.log_dir, f"{session_id}.jsonl") if self.log_dir else None
+        self._creating += 1
+        try:
+            agent = await MCPAgent.create(
+                mcp_server_config_path=self.mcp_config_path,
+                log_messages_path=log_path,
+                server_pool=self.server_pool,
+                llm_client=self.llm,
+                tool_cache=self.tool_cache,
+                verbose=False,
+                **self.agent_options
+            )
+        finally:
+            self._creating -= 1
+        session = self._sessions[session_id] = _Session(session_id, agent)
+        return session
+
+    def get_session(self, session_id: str) -> _Session:
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise ServiceError(404, f"Unknown session: {session_id}")
+        return session
+
+    async def close_session(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise ServiceError(404, f"Unknown session: {session_id}")
+        # 等待正在进行的问题结束后再归还服务器
+        async with session.lock:
+            await session.agent.cleanup()
+
+    async def _admit(self, session: _Session):
+        """Take the session lock and a global prompt slot, or raise ServiceError."""
+        if session.lock.locked():
+            raise ServiceError(409, "Session is busy with another prompt")
+        await session.lock.acquire()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._prompt_slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            session.lock.release()
+            raise ServiceError(503, "Service is busy, try again later")
+        except BaseException:
+            session.lock.release()
+            raise
+        SERVICE_QUEUE_SECONDS.observe(time.perf_counter() - start)
+
+    def _leave(self, session: _Session):
+        self._prompt_slots.release()
+        session.last_used = time.monotonic()
+        session.lock.release()
+
+    async def prompt(self, session: _Session, query: str) -> str:
+        await self._admit(session)
+        try:
+            return await session.agent.prompt(query, stream=False)
+        except LLMRequestError as e:
+            raise self._llm_error(e)
+        finally:
+            self._leave(session)
+
+    @staticmethod
+    def _llm_error(e: LLMRequestError) -> ServiceError:
+        # 上游限流仍然失败时返回 503，其它 LLM 错误返回 502
+        return ServiceError(503 if e.status == 429 else 502, str(e))
+
+    async def prompt_stream(self, session: _Session, query: str):
+        """
+        Admit the prompt now and return an async generator of text chunks;
+        the slot is held until the generator finishes or is closed.
+        """
+        await self._admit(session)
+        try:
+            generator = await session.agent.prompt(query, stream=True)
+        except BaseException:
+            self._leave(session)
+            raise
+
+        async def chunks():
+            try:
+                async for chunk in generator:
+                    yield chunk
+            finally:
+                await generator.aclose()
+                self._leave(session)
+        return chunks()
+
+    async def _reap_loop(self):
+        interval = max(1.0, min(60.0, self.session_idle_timeout / 2))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session_id, session in list(self._sessions.items()):
+                if not session.lock.locked() and now - session.last_used >= self.session_idle_timeout:
+                    logger.info(f"Closing idle session {session_id}")
+                    try:
+                        await self.close_session(session_id)
+                    except ServiceError:
+                        pass
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self._sessions),
+            "busy_sessions": sum(1 for s in self._sessions.values() if s.lock.locked()),
+            "servers": self.server_pool.stats(),
+            "tool_cache": self.tool_cache.stats(),
+            "llm": self.llm.scheduler.stats()
+        }
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        await asyncio.gather(*[s.agent.cleanup() for s in sessions], return_exceptions=True)
+        if self._close_pool:
+            await self.server_pool.close()
+        if self._close_llm:
+            await self.llm.close()
+
+
+def create_app(manager: SessionManager) -> Starlette:
+    def error_response(e: ServiceError):
+        return JSONResponse({"error": str(e)}, status_code=e.status)
+
+    async def create_session(request):
+        try:
+            session = await manager.create_session()
+        except ServiceError as e:
+            return error_response(e)
+        return JSONResponse({
+            "session_id": session.session_id,
+            "servers": session.agent.startup_report,
+            "tools": len(session.agent.all_functions)
+        }, status_code=201)
+
+    async def delete_session(request):
+        try:
+            await manager.close_session(request.path_params["session_id"])
+        except ServiceError as e:
+            return error_response(e)
+        return JSONResponse({"deleted": True})
+
+    async def post_message(request):
+        try:
+            body = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return JSONResponse({"error": "Body must be JSON"}, status_code=400)
+        query = body.get("query") if isinstance(body, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            return JSONResponse({"error": "Missing query"}, status_code=400)
+        try:
+            session = manager.get_session(request.path_params["session_id"])
+            if not body.get("stream"):
+                start = time.perf_counter()
+                text = await manager.prompt(session, query)
+                SERVICE_REQUESTS_TOTAL.inc(transport="http", status="ok")
+                return JSONResponse({"text": text, "elapsed": time.perf_counter() - start,
+                                     "usage": session.agent.last_usage})
+            chunks = await manager.prompt_stream(session, query)
+        except ServiceError as e:
+            SERVICE_REQUESTS_TOTAL.inc(transport="http", status=str(e.status))
+            return error_response(e)
+
+        async def events():
+            try:
+                async for chunk in chunks:
+                    yield f"data: {codec.dumps({'text': chunk})}\n\n"
+                yield f"event: done\ndata: {codec.dumps({'usage': session.agent.last_usage})}\n\n"
+                SERVICE_REQUESTS_TOTAL.inc(transport="sse", status="ok")
+            except Exception as e:
+                logger.error(f"Streaming prompt failed: {str(e)}")
+                SERVICE_REQUESTS_TOTAL.inc(transport="sse", status="error")
+                yield f"event: error\ndata: {codec.dumps({'error': str(e)})}\n\n"
+            finally:
+                # 客户端断开时立即归还会话锁和并发槽，不等垃圾回收
+                await chunks.aclose()
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+
+    async def websocket_session(websocket: WebSocket):
+        await websocket.accept()
+        try:
+            session = manager.get_session(websocket.path_params["session_id"])
+        except ServiceError as e:
+            await websocket.send_json({"type": "error", "error": str(e), "status": e.status})
+            await websocket.close()
+            return
+        try:
+            while True:
+                message = await websocket.receive_json()
+                query = message.get("query") if isinstance(message, dict) else None
+                if not isinstance(query, str) or not query.strip():
+                    await websocket.send_json({"type": "error", "error": "Missing query", "status": 400})
+                    continue
+                try:
+                    chunks = await manager.prompt_stream(session, query)
+                except ServiceError as e:
+                    SERVICE_REQUESTS_TOTAL.inc(transport="ws", status=str(e.status))
+                    await websocket.send_json({"type": "error", "error": str(e), "status": e.status})
+                    continue
+                text = []
+                try:
+                    async for chunk in chunks:
+                        text.append(chunk)
+                        await websocket.send_json({"type": "chunk", "text": chunk})
+                except WebSocketDisconnect:
+                    raise
+                except Exception as e:
+                    logger.error(f"Streaming prompt failed: {str(e)}")
+                    SERVICE_REQUESTS_TOTAL.inc(transport="ws", status="error")
+                    await websocket.send_json({"type": "error", "error": str(e), "status": 500})
+                    continue
+                finally:
+                    await chunks.aclose()
+                SERVICE_REQUESTS_TOTAL.inc(transport="ws", status="ok")
+                await websocket.send_json({"type": "done", "text": "".join(text), "usage": session.agent.last_usage})
+        except WebSocketDisconnect:
+            pass
+
+    async def health(request):
+        return JSONResponse({"status": "ok", **manager.stats()})
+
+    async def metrics_endpoint(request):
+        return PlainTextResponse(metrics.to_prometheus(), media_type="text/plain; version=0.0.4")
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        await manager.start()
+        try:
+            yield
+        finally:
+            await manager.close()
+
+    return Starlette(
+        routes=[
+            Route("/sessions", create_session, methods=["POST"]),
+            Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+            Route("/sessions/{session_id}/messages", post_message, methods=["POST"]),
+            WebSocketRoute("/sessions/{session_id}/ws", websocket_session),
+            Route("/health", health),
+            Route("/metrics", metrics_endpoint),
+        ],
+        lifespan=lifespan
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", required=True, help="path of mcp_servers_config.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--log-dir", help="write one message log per session into this directory")
+    parser.add_argument("--max-sessions", type=int, default=100)
+    parser.add_argument("--max-concurrent-prompts", type=int, default=16)
+    parser.add_argument("--queue-timeout", type=float, default=30, help="seconds a prompt may wait for a slot")
+    parser.add_argument("--session-idle-timeout", type=float, default=1800)
+    parser.add_argument("--eager", action="store_true",
+                        help="start every server when a session is created instead of on first use")
+    parser.add_argument("--llm-rpm", type=float, help="LLM requests per minute (default: DS_REQUESTS_PER_MINUTE)")
+    parser.add_argument("--llm-tpm", type=float, help="LLM tokens per minute (default: DS_TOKENS_PER_MINUTE)")
+    parser.add_argument("--llm-max-concurrency", type=int,
+                        help="LLM requests in flight across all sessions (default: DS_MAX_CONCURRENCY or 16)")
+    args = parser.parse_args()
+    get_llm_scheduler().configure(args.llm_rpm, args.llm_tpm, args.llm_max_concurrency)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    manager = SessionManager(
+        mcp_config_path=args.config,
+        log_dir=args.log_dir,
+        max_sessions=args.max_sessions,
+        max_concurrent_prompts=args.max_concurrent_prompts,
+        queue_timeout=args.queue_timeout,
+        session_idle_timeout=args.session_idle_timeout,
+        agent_options={"lazy_start": not args.eager}
+    )
+    uvicorn.run(create_app(manager), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,16 @@ def load_config_from_file(file_path: str) -> dict:
 
 # 处理deepseek-r1的reasoning_content
 def clean_reasoning_content(conversation):
-    for message in conversation:
-        if 'reasoning_content' in message:
-            del message['reasoning_content']
+    """
+    Return the conversation without reasoning_content fields.
+
+    The history itself is left untouched: messages that carry the field are
+    copied, all others are passed through as the same objects, so repeated
+    calls produce byte-identical requests.
+    """
+    if not any('reasoning_content' in message for message in conversation):
+        return conversation
+    return [
+        {k: v for k, v in message.items() if k != 'reasoning_content'} if 'reasoning_content' in message else message
+        for message in conversation
+    ]